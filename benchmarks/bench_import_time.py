@@ -0,0 +1,61 @@
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+PAGE_PACKAGE = 'dashboardapp.plotlydashapp.pages.digital_twin.digital_twin_key_facilities'
+DEFAULT_MODULES = [
+    'dashboardapp.contentmanager.digital_twin_key_facilities',
+    PAGE_PACKAGE + '.layout',
+    PAGE_PACKAGE + '.callbacks',
+]
+# modules deferred until a map is built or a Process run starts
+DEFERRED_MODULES = [
+    'dashboardapp.contentmanager.digital_twin_key_facilities_maps',
+    'dashboardapp.calculationmanager.grid_tools',
+    'dashboardapp.calculationmanager.revenue_engine',
+]
+HEAVY_MODULES = ['matplotlib', 'shapely', 'colorlover', 'plotly.graph_objs', 'scipy.sparse', 'geojson']
+IMPORT_REPEATS = 5
+
+IMPORT_SCRIPT = '''
+import sys, json, time
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'heavy': [m for m in %r if m in sys.modules]}))
+''' % HEAVY_MODULES
+
+
+def measure_import(modules, repeats=IMPORT_REPEATS):
+    # every repeat is a fresh interpreter, so each one is a cold import
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT] + modules, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {'seconds': statistics.median(run['seconds'] for run in runs), 'heavy': runs[0]['heavy']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cold import time of the key facilities page, with and without '
+                                                 'the modules it now defers.')
+    parser.add_argument('--modules', default=','.join(DEFAULT_MODULES))
+    parser.add_argument('--repeats', type=int, default=IMPORT_REPEATS)
+    args = parser.parse_args(argv)
+
+    for module in args.modules.split(','):
+        lazy = measure_import([module], args.repeats)
+        eager = measure_import([module] + DEFERRED_MODULES, args.repeats)
+        print(module)
+        print('  at boot            {:>8.3f} s  loads {}'.format(lazy['seconds'], ', '.join(lazy['heavy']) or '-'))
+        print('  with deferred deps {:>8.3f} s  loads {}'.format(eager['seconds'], ', '.join(eager['heavy']) or '-'))
+        print('  saved at boot      {:>8.3f} s'.format(eager['seconds'] - lazy['seconds']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
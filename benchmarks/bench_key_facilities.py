@@ -0,0 +1,253 @@
+import os
+import sys
+import gc
+import json
+import time
+import atexit
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from unittest import mock
+
+from dashboardapp.contentmanager.content_manager import ContentManager
+from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
+from dashboardapp.calculationmanager.grid_engine import get_grid_ids, get_grid_column
+from dashboardapp.calculationmanager.market_index import invalidate_market_index
+from dashboardapp.calculationmanager.grid_lookup import GridCountryLookup, grid_country_lookups, \
+    grid_country_lookups_lock
+
+from benchmarks.synthetic import make_key_facilities_inputs, write_grid_country_lookup
+
+
+BENCHMARK_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_SIZES = [1000, 10000, 100000]
+BENCHMARK_REPEATS = 3
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# in CI a missing baseline fails the run instead of passing it unchecked
+BENCHMARK_CI = os.environ.get('CI', '').lower() in ('1', 'true', 'yes')
+# a stage regresses when it is this much slower or larger than the baseline
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.10
+# and by at least this many seconds, as stages of a few milliseconds vary by more than the tolerance from run to run
+TIME_MIN_REGRESSION = 0.05
+MARKET_BREAKDOWN_ID = 'benchmark-market-breakdown'
+SWEEP_SCENARIOS = 4
+
+
+class InMemoryKeyFacilitiesContentManager(KeyFacilitiesContentManager):
+    # Stand-in for the store backed ContentManager: children live in a dict per record id and market breakdowns
+    # are served from a dict, so the pipeline runs without a database or the market breakdowns page.
+    def __init__(self, store=None, markets=None, record_id='benchmark'):
+        # only the store base class is skipped; the key facilities state comes from its own __init__
+        with mock.patch.object(ContentManager, '__init__', lambda self, *args, **kwargs: None):
+            super().__init__()
+        self.msg = None
+        self.store = {} if store is None else store
+        self.markets = {} if markets is None else markets
+        self.current_id = record_id
+
+    def get_current_id(self):
+        return self.current_id
+
+    def update_current_id(self, record_id):
+        self.reset_children()
+        self.current_id = record_id
+        return None
+
+    def make_current(self):
+        self.memo = {}
+        self.reset_children()
+        return None
+
+    def read_children(self, children):
+        record = self.store.get(self.current_id, {})
+        return {child: record.get(child) for child in children}
+
+    def write_children(self, children):
+        self.store.setdefault(self.current_id, {}).update(children)
+        return None
+
+    def get_market_breakdown_version(self, market_breakdown_id):
+        return None
+
+    def load_market_breakdown_outputs(self, market_breakdown_id):
+        return self.markets[market_breakdown_id]
+
+
+synthetic_grid_lookup = None
+
+
+def install_grid_country_lookup():
+    # The synthetic countries are on no real map, so GridTools would find other countries and no region. The 1deg
+    # lookup the pipeline reads is set to one of the synthetic country boxes, built once per process.
+    global synthetic_grid_lookup
+    if synthetic_grid_lookup is None:
+        directory = tempfile.mkdtemp(prefix='key_facilities_grid_lookup_')
+        atexit.register(shutil.rmtree, directory, True)
+        write_grid_country_lookup(directory)
+        synthetic_grid_lookup = GridCountryLookup('1deg', directory)
+    with grid_country_lookups_lock:
+        grid_country_lookups['1deg'] = synthetic_grid_lookup
+    return None
+
+
+def make_content_manager(inputs):
+    install_grid_country_lookup()
+    cm = InMemoryKeyFacilitiesContentManager(markets={MARKET_BREAKDOWN_ID: inputs['market_breakdown']})
+    # saved as table children so they carry table versions, as uploads do; every call is a new version
+    for child in ['facilities_inputs', 'production_volumes_inputs', 'product_map_inputs']:
+        cm.save_table_child(child, inputs[child].to_dict(orient='records'))
+    cm.save_child('market_breakdown_id', MARKET_BREAKDOWN_ID)
+    invalidate_market_index(MARKET_BREAKDOWN_ID)
+    return cm
+
+
+def bench_grid_ids(inputs):
+    df = inputs['facilities_inputs']
+    get_grid_ids(df['lat'], df['lon'])
+    return None
+
+
+def bench_grid_countries(inputs):
+    df = inputs['facilities_inputs'].copy()
+    df[get_grid_column('1deg')] = get_grid_ids(df['lat'], df['lon'], ['1deg'])['1deg']
+    cm = make_content_manager(inputs)
+    start = time.perf_counter()
+    cm.get_grid_countries(df)
+    return time.perf_counter() - start
+
+
+def bench_facility_revenues(inputs):
+    cm = make_content_manager(inputs)
+    # countries come from the generator so the stage does not depend on the grid data
+    df = inputs['facilities_inputs'].copy()
+    df['grid_country'] = df['country']
+    cm.get_facility_revenues(df, inputs['production_volumes_inputs'], inputs['product_map_inputs'],
+                             cm.get_market_index(MARKET_BREAKDOWN_ID))
+    return None
+
+
+def bench_process(inputs):
+    make_content_manager(inputs).process_key_facilities_inputs()
+    return None
+
+
+def bench_map_data(inputs):
+    cm = make_content_manager(inputs)
+    cm.process_key_facilities_inputs()
+    cm.make_current()
+    start = time.perf_counter()
+    cm.get_map_data()
+    return time.perf_counter() - start
+
+
+def bench_sweep(inputs):
+    cm = make_content_manager(inputs)
+    # the same breakdown under several ids, so every scenario builds its own market index
+    market_breakdown_ids = ['{}-{}'.format(MARKET_BREAKDOWN_ID, i) for i in range(SWEEP_SCENARIOS)]
+    for market_breakdown_id in market_breakdown_ids:
+        cm.markets[market_breakdown_id] = inputs['market_breakdown']
+        invalidate_market_index(market_breakdown_id)
+    cm.sweep_market_breakdowns(market_breakdown_ids)
+    return None
+
+
+# stages returning a duration only time their own section, the rest are timed end to end; peak memory always
+# covers the whole stage function
+BENCHMARK_STAGES = {
+    'grid_ids': bench_grid_ids,
+    'grid_countries': bench_grid_countries,
+    'facility_revenues': bench_facility_revenues,
+    'process': bench_process,
+    'map_data': bench_map_data,
+    'sweep': bench_sweep,
+}
+
+
+def measure(stage, inputs, repeats=BENCHMARK_REPEATS):
+    # best wall time over the repeats, then one separate run under tracemalloc for the peak
+    seconds = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        duration = stage(inputs)
+        seconds.append(duration if duration is not None else time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage(inputs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_mb': peak / 1024 ** 2}
+
+
+def run(sizes, stages, repeats=BENCHMARK_REPEATS, seed=0):
+    results = {}
+    for n in sizes:
+        inputs = make_key_facilities_inputs(n, seed)
+        for name in stages:
+            key = '{}/{}'.format(name, n)
+            results[key] = measure(BENCHMARK_STAGES[name], inputs, repeats)
+            print('{:<28} {:>10.3f} s {:>10.1f} MB'.format(key, results[key]['seconds'], results[key]['peak_mb']))
+    return results
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        if result['seconds'] > max(baseline[key]['seconds'] * (1 + time_tolerance),
+                                   baseline[key]['seconds'] + TIME_MIN_REGRESSION):
+            regressions.append('{}: {:.3f} s against a baseline of {:.3f} s'.format(
+                key, result['seconds'], baseline[key]['seconds']))
+        if result['peak_mb'] > baseline[key]['peak_mb'] * (1 + memory_tolerance):
+            regressions.append('{}: {:.1f} MB against a baseline of {:.1f} MB'.format(
+                key, result['peak_mb'], baseline[key]['peak_mb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the key facilities pipeline on synthetic data.')
+    parser.add_argument('--sizes', default=','.join(str(n) for n in DEFAULT_SIZES),
+                        help='comma separated facility counts, up to {}'.format(BENCHMARK_SIZES[-1]))
+    parser.add_argument('--stages', default=','.join(BENCHMARK_STAGES))
+    parser.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE)
+    parser.add_argument('--ci', action='store_true', default=BENCHMARK_CI,
+                        help='fail when there is no baseline to compare against (default on when CI is set)')
+    args = parser.parse_args(argv)
+
+    sizes = [int(n) for n in args.sizes.split(',')]
+    results = run(sizes, args.stages.split(','), args.repeats, args.seed)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}, run with --save-baseline to record one.'.format(args.baseline))
+        return 1 if args.ci else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
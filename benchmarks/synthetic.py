@@ -0,0 +1,152 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+
+REGIONS = ['Europe', 'North America', 'Latin America', 'Asia Pacific', 'Middle East & Africa']
+FACILITY_TYPES = ['PL: Production Plants', 'RD: Research & Development', 'WH: Warehouses', 'HQ: Headquarters']
+COUNTRIES_PER_REGION = 12
+PRODUCTS = 60
+END_PRODUCTS = 25
+PRODUCTS_PER_FACILITY = 3
+# share of facilities uploaded without a company id, which go through name reconciliation
+MISSING_ID_SHARE = 0.2
+# share of those whose name is misspelled, which go through the fuzzy pass
+MISSPELLED_SHARE = 0.3
+# (south, west, north, east) of the area the synthetic countries tile, one row of boxes per region
+COUNTRY_AREA = (-50, -168, 70, 168)
+
+
+def get_countries():
+    return {'{} {:02d}'.format(region, i): region for region in REGIONS for i in range(COUNTRIES_PER_REGION)}
+
+
+def get_country_boxes():
+    # (south, west, north, east) of every synthetic country; the edges are whole degrees, so every 1deg cell lies in
+    # one box and a lookup of the boxes gives each facility the country it was generated in
+    south, west, north, east = COUNTRY_AREA
+    height = (north - south) // len(REGIONS)
+    width = (east - west) // COUNTRIES_PER_REGION
+    boxes = {}
+    for row, region in enumerate(REGIONS):
+        for col in range(COUNTRIES_PER_REGION):
+            boxes['{} {:02d}'.format(region, col)] = (south + row * height, west + col * width,
+                                                      south + (row + 1) * height, west + (col + 1) * width)
+    return boxes
+
+
+def write_grid_country_lookup(directory, scale='1deg'):
+    # a GridCountryLookup table of the synthetic countries, laid out as grid_lookup.build_grid_country_table writes
+    # it; cells outside every box have no country and are flagged for the GridTools path
+    from dashboardapp.calculationmanager.grid_engine import get_grid_shape
+    from dashboardapp.calculationmanager.grid_lookup import GRID_RESOLUTIONS, GRID_LOOKUP_VERSION, get_table_paths
+
+    resolution = GRID_RESOLUTIONS[scale]
+    n_rows, n_cols = get_grid_shape(scale)
+    index = np.arange(n_rows * n_cols)
+    lats = 90 - (index // n_cols + 0.5) * resolution
+    lons = (index % n_cols + 0.5) * resolution - 180
+    boxes = get_country_boxes()
+    codes = np.full(len(index), -1, dtype=np.int16)
+    for code, (south, west, north, east) in enumerate(boxes.values()):
+        codes[(lats > south) & (lats < north) & (lons > west) & (lons < east)] = code
+
+    os.makedirs(directory, exist_ok=True)
+    paths = get_table_paths(scale, directory, GRID_LOOKUP_VERSION)
+    np.save(paths['codes'], codes)
+    np.save(paths['border'], codes < 0)
+    with open(paths['countries'], 'w') as f:
+        json.dump(list(boxes), f)
+    return paths
+
+
+def make_facility_names(rng, n):
+    words = np.array(['North', 'South', 'River', 'Valley', 'Harbour', 'Central', 'Lake', 'Hill', 'Bay', 'Park'])
+    first = words[rng.integers(len(words), size=n)].astype(object)
+    second = words[rng.integers(len(words), size=n)].astype(object)
+    return first + ' ' + second + ' Plant ' + pd.Series(np.arange(n)).astype(str).str.zfill(7).values
+
+
+def make_facilities(n, seed=0):
+    rng = np.random.default_rng(seed)
+    boxes = get_country_boxes()
+    countries = np.array(list(boxes))[rng.integers(len(boxes), size=n)]
+    south, west, north, east = np.array([boxes[country] for country in countries], dtype=float).reshape(-1, 4).T
+    names = make_facility_names(rng, n)
+    facility_ids = np.array(['F{:07d}'.format(i) for i in range(n)], dtype=object)
+    missing = rng.random(n) < MISSING_ID_SHARE
+    misspelled = missing & (rng.random(n) < MISSPELLED_SHARE)
+    uploaded_names = names.copy()
+    uploaded_names[misspelled] = [name[:-1] for name in names[misspelled]]
+    facility_ids[missing] = None
+    return pd.DataFrame({
+        'id': np.arange(n),
+        'facility_uid': ['U{:07d}'.format(i) for i in range(n)],
+        'facility_id': facility_ids,
+        'facility_name': uploaded_names,
+        'facility_type': np.array(FACILITY_TYPES)[rng.integers(len(FACILITY_TYPES), size=n)],
+        # inside the box of the facility's country, so the grid lookup finds that country
+        'lat': south + rng.random(n) * (north - south),
+        'lon': west + rng.random(n) * (east - west),
+        'country': countries,
+        'revenue_share': rng.uniform(0, 5, n),
+    })
+
+
+def make_production_volumes(facilities, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    n = len(facilities)
+    rows = np.repeat(np.arange(n), PRODUCTS_PER_FACILITY)
+    names = make_facility_names(np.random.default_rng(seed), n)
+    return pd.DataFrame({
+        'id': np.arange(len(rows)),
+        'facility_id': ['F{:07d}'.format(i) for i in rows],
+        # volume names carry a three character prefix that the reconciler strips
+        'facility_name': 'PL ' + pd.Series(names[rows]),
+        'country': facilities['country'].values[rows],
+        'product': ['P{:03d}'.format(i) for i in rng.integers(PRODUCTS, size=len(rows))],
+        'volume': rng.uniform(1, 1000, len(rows)),
+    })
+
+
+def make_product_map(seed=0):
+    rng = np.random.default_rng(seed + 2)
+    rows = []
+    for product in range(PRODUCTS):
+        end_products = rng.choice(END_PRODUCTS, size=3, replace=False)
+        shares = rng.dirichlet(np.ones(3)) * 100
+        for end_product, share in zip(end_products, shares):
+            rows.append({'product': 'P{:03d}'.format(product), 'end_product': 'E{:03d}'.format(end_product),
+                         'share': share})
+    product_map = pd.DataFrame(rows)
+    product_map.insert(0, 'id', np.arange(len(product_map)))
+    return product_map
+
+
+def make_market_breakdown(seed=0):
+    rng = np.random.default_rng(seed + 3)
+    rows = [{'product_group': 'Total', 'product': 'Total', 'region': 'Total', 'sub_region': 'Total',
+             'country': None, 'result': 0.0}]
+    for end_product in range(END_PRODUCTS):
+        product = 'E{:03d}'.format(end_product)
+        for region in REGIONS + ['Total']:
+            result = rng.uniform(100, 10000)
+            rows.append({'product_group': 'End products', 'product': product, 'region': region,
+                         'sub_region': 'Total', 'country': None, 'result': result})
+            rows[0]['result'] += result if region == 'Total' else 0
+    for country, region in get_countries().items():
+        rows.append({'product_group': 'Countries', 'product': None, 'region': region, 'sub_region': country,
+                     'country': country, 'result': np.nan})
+    return rows
+
+
+def make_key_facilities_inputs(n, seed=0):
+    facilities = make_facilities(n, seed)
+    return {
+        'facilities_inputs': facilities,
+        'production_volumes_inputs': make_production_volumes(facilities, seed),
+        'product_map_inputs': make_product_map(seed),
+        'market_breakdown': make_market_breakdown(seed),
+    }
@@ -0,0 +1,97 @@
+import os
+import uuid
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+# Optional columnar backend for large children; stays off unless a shared directory is configured.
+COLUMNAR_DIR = os.environ.get('KEY_FACILITIES_COLUMNAR_DIR')
+COLUMNAR_FORMAT = 'arrow_ipc'
+COLUMNAR_SCHEMA_VERSION = 1
+COLUMNAR_COMPRESSION = 'zstd'
+
+
+def is_columnar_reference(value):
+    return isinstance(value, dict) and value.get('format') == COLUMNAR_FORMAT
+
+
+def to_arrow_table(table):
+    if isinstance(table, pa.Table):
+        return table
+    # row dicts may not share keys, so go through a DataFrame to keep the union of columns
+    return pa.Table.from_pandas(pd.DataFrame(table), preserve_index=False)
+
+
+class ColumnarStore:
+    # Children are written as compressed Arrow IPC (Feather v2) files; the store keeps a small reference dict.
+    def __init__(self, directory=COLUMNAR_DIR):
+        self.directory = directory
+
+    def is_enabled(self):
+        return self.directory is not None
+
+    def get_path(self, reference):
+        return os.path.join(self.directory, reference['file'])
+
+    def write(self, table):
+        # a RecordBatchReader, e.g. an upload, is written batch by batch without being collected into one table
+        reader = table if isinstance(table, pa.RecordBatchReader) else to_arrow_table(table).to_reader()
+        metadata = dict(reader.schema.metadata or {})
+        metadata[b'key_facilities_schema_version'] = str(COLUMNAR_SCHEMA_VERSION).encode()
+        schema = reader.schema.with_metadata(metadata)
+
+        os.makedirs(self.directory, exist_ok=True)
+        reference = {
+            'format': COLUMNAR_FORMAT,
+            'schema_version': COLUMNAR_SCHEMA_VERSION,
+            'file': self.make_file_name(),
+            'num_rows': 0,
+            'columns': schema.names,
+        }
+        path = self.get_path(reference)
+        # the Arrow IPC file format is Feather v2, so read_table reads it as feather.write_feather would have written it
+        options = pa.ipc.IpcWriteOptions(compression=COLUMNAR_COMPRESSION)
+        try:
+            with pa.ipc.new_file(path + '.tmp', schema, options=options) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+                    reference['num_rows'] += batch.num_rows
+        except BaseException:
+            self.delete(dict(reference, file=reference['file'] + '.tmp'))
+            raise
+        os.replace(path + '.tmp', path)
+        return reference
+
+    def read_table(self, reference, columns=None):
+        if reference['schema_version'] > COLUMNAR_SCHEMA_VERSION:
+            raise ValueError('Unsupported key facilities schema version {}'.format(reference['schema_version']))
+        if columns is not None:
+            columns = [col for col in columns if col in reference['columns']]
+        return feather.read_table(self.get_path(reference), columns=columns, memory_map=True)
+
+    def read(self, reference, columns=None):
+        return self.read_table(reference, columns).to_pandas()
+
+    def make_file_name(self):
+        return uuid.uuid4().hex + '.arrow'
+
+    def copy(self, reference):
+        # a reference is owned by one record, which deletes its file when the child is saved again
+        copied = dict(reference, file=self.make_file_name())
+        path = self.get_path(copied)
+        shutil.copyfile(self.get_path(reference), path + '.tmp')
+        os.replace(path + '.tmp', path)
+        return copied
+
+    def delete(self, reference):
+        try:
+            os.remove(self.get_path(reference))
+        except OSError:
+            pass
+        return None
+
+
+columnar_store = ColumnarStore()
@@ -3,43 +3,328 @@ import dash_html_components as html
 import dash_core_components as dcc
 from dash_table.Format import Format, Scheme, Sign
 import dash_table
-import plotly.graph_objs as go
-import colorlover as cl
-from matplotlib.colors import LinearSegmentedColormap
-from shapely.ops import unary_union
-import geojson
 import numpy as np
+import pyarrow as pa
 import uuid
+import functools
+from collections import OrderedDict
 
 from dashboardapp.settings import MAPBOX_ACCESS_TOKEN
 from dashboardapp.contentmanager.content_manager import ContentManager
 from dashboardapp.contentmanager.digital_twin_market_breakdowns import MarketBreakdownsContentManager
-from dashboardapp.calculationmanager.grid_tools import GridTools
+from dashboardapp.contentmanager.columnar_store import columnar_store, is_columnar_reference
+from dashboardapp.contentmanager.table_paging import (TABLE_PAGE_SIZE, table_cache, get_page, apply_patch,
+                                                      set_custom_paging)
+from dashboardapp.calculationmanager.grid_engine import GRID_COLUMNS, get_grid_ids, get_grid_column
+from dashboardapp.calculationmanager.grid_lookup import get_grid_country_lookup
+from dashboardapp.calculationmanager.market_index import get_market_index
+from dashboardapp.calculationmanager.facility_reconciliation import get_reconciler
+from dashboardapp.instrumentation import StageTimer, record_spans
+
+
+# children saved through save_table_child, and so possibly held in the columnar store
+TABLE_CHILDREN = ['facilities_inputs', 'production_volumes_inputs', 'product_map_inputs', 'outputs']
+MAP_ZOOM = 0.8
+# share of the view's width and height loaded past each edge, so small pans keep the facilities already sent
+MAP_BOUNDS_PADDING = 0.5
+# column of the record table holding when a record was last saved, the version of a market breakdown's outputs
+RECORD_MODIFIED_COLUMN = 'modified'
+# child holding the version of the market index the saved outputs were computed against
+OUTPUTS_MARKET_VERSION_CHILD = 'outputs_market_version'
+# facilities are drawn as per-cell clusters below each zoom limit, and as raw points past the last one
+MAP_CLUSTER_BANDS = [(3, get_grid_column('1deg')), (4.5, get_grid_column('30arcmin')), (6, get_grid_column('15arcmin')),
+                     (7.5, get_grid_column('5arcmin'))]
+MAP_REVENUE_OPTIONS = [
+    {'label': 'Input assumption', 'value': 'input_assumption_revenue'},
+    {'label': 'Region assumption', 'value': 'region_assumption_revenue'},
+    {'label': 'Global assumption', 'value': 'global_assumption_revenue'},
+]
+MAP_REVENUE_OPTION = 'global_assumption_revenue'
+
+
+def make_map_layout(zoom_level, access_token):
+    # a plain dict, shared by the map figures and the placeholder the page boots with
+    lat_center = 73.3 - 57.9
+
+    layout = dict(
+        mapbox={
+            'style': 'light',#'open-street-map',  # 'stamen-terrain' 'white-bg', 'satellite' 'carto-positron, carto-darkmatter, stamen-terrain, stamen-toner, stamen-watercolor
+            'center': {'lat': lat_center, 'lon': 0},
+            'zoom': zoom_level,
+            'accesstoken': access_token
+        },
+        margin={'l': 0, 'r': 0, 'b': 0, 't': 0},
+        # keeps the user's pan and zoom when the traces are swapped for another level of detail
+        uirevision='key-facilities-map',
+        legend={
+            'orientation': 'h',
+            'xanchor': 'right',
+            'x': 1,
+            'yanchor': 'bottom',
+            'y': 1,
+        },
+    )
+    return layout
+
+
+def batched(method):
+    # saves made inside method are held back and written together when the outermost batched method returns,
+    # and dropped if it raises
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.unit_of_work_depth += 1
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            self.unit_of_work_depth -= 1
+            if self.unit_of_work_depth == 0:
+                self.rollback_children()
+            raise
+        self.unit_of_work_depth -= 1
+        if self.unit_of_work_depth == 0:
+            self.commit_children()
+        return result
+    return wrapper
+
+
+def has_duplicates(df, column):
+    return column in df.columns and df[column].dropna().duplicated().any()
+
+
+def is_in(values, candidates):
+    # pandas' Arrow string isin converts every candidate to a scalar one by one; object arrays are hashed instead
+    return pd.Index(np.asarray(values, dtype=object)).isin(np.asarray(candidates, dtype=object))
+
+
+def has_changed(values, previous_values):
+    # element-wise inequality where two missing values count as equal
+    values = pd.Series(np.asarray(values, dtype=object))
+    previous_values = pd.Series(np.asarray(previous_values, dtype=object))
+    return (values.ne(previous_values) & ~(values.isna() & previous_values.isna())).values
+
+
+def is_in_bounds(lat, lon, bounds):
+    # bounds is [west, south, east, north]; longitudes are compared modulo 360 as views may cross the antimeridian
+    west, south, east, north = bounds
+    mask = (np.asarray(lat) >= south) & (np.asarray(lat) <= north)
+    if east - west < 360:
+        mask &= np.mod(np.asarray(lon) - west, 360) <= east - west
+    return mask
 
 
 class KeyFacilitiesContentManager(ContentManager):
     def __init__(self):
+        # per-request memo of derived outputs, dropped whenever the current record changes or a child is saved
+        self.memo = {}
+        # per-request copy of the children of the current record and the saves of the open unit of work
+        self.children = {}
+        self.dirty_children = {}
+        self.on_commit = []
+        self.on_rollback = []
+        self.unit_of_work_depth = 0
         super().__init__('digital_twin_key_facilities')
+        self.unmatched_facilities = []
+        self.stale_regions = set()
+        self.facilities_removed = False
+        self.progress_callback = None
+        self.stage_timer = StageTimer()
+
+    def make_current(self):
+        self.memo = {}
+        self.reset_children()
+        return super().make_current()
+
+    def update_current_id(self, record_id):
+        self.reset_children()
+        return super().update_current_id(record_id)
+
+    def reset_children(self):
+        if len(self.dirty_children) > 0:
+            self.commit_children()
+        self.children = {}
+        return None
+
+    def copy(self, record_id):
+        # The store copies a columnar child as its reference dict, so both records would share one file and the
+        # first save of either would delete it under the other. The copy, current once copied, gets files of its own.
+        self.reset_children()
+        result = super().copy(record_id)
+        self.memo = {}
+        self.reset_children()
+        if columnar_store.is_enabled() and self.get_current_id() != record_id:
+            self.copy_columnar_children()
+        return result
+
+    @batched
+    def copy_columnar_children(self):
+        for child in TABLE_CHILDREN:
+            value = self.get_child_from_current(child)
+            if is_columnar_reference(value):
+                copied = columnar_store.copy(value)
+                self.save_child(child, copied)
+                self.on_rollback.append(functools.partial(columnar_store.delete, copied))
+        return None
+
+    def delete(self, record_id):
+        # columnar files are not store records, so they are removed with the record that owns them
+        references = self.get_columnar_references(record_id) if columnar_store.is_enabled() else []
+        result = super().delete(record_id)
+        for reference in references:
+            columnar_store.delete(reference)
+        return result
+
+    def get_columnar_references(self, record_id):
+        current_id = self.get_current_id()
+        self.update_current_id(record_id)
+        self.make_current()
+        references = [self.get_child_from_current(child) for child in TABLE_CHILDREN]
+        self.update_current_id(current_id)
+        self.make_current()
+        return [reference for reference in references if is_columnar_reference(reference)]
+
+    def get_child_from_current(self, child):
+        # each child is read from the store on its first access of a request and kept for the rest of it
+        if child not in self.children:
+            self.children.update(self.read_children([child]))
+        return self.children[child]
+
+    def read_children(self, children):
+        # the single place children are read from the store, one call per child as ContentManager has no
+        # multi-child query
+        values = {}
+        for child in children:
+            values[child] = super().get_child_from_current(child)
+        return values
+
+    def save_child(self, child, data):
+        self.memo = {}
+        self.children[child] = data
+        if self.unit_of_work_depth > 0:
+            self.dirty_children[child] = data
+            return None
+        return self.write_children({child: data})
+
+    def write_children(self, children):
+        # as read_children, the single place for a multi-child store write
+        for child, data in children.items():
+            super().save_child(child, data)
+        return None
+
+    def commit_children(self):
+        dirty, self.dirty_children = self.dirty_children, {}
+        on_commit, self.on_commit, self.on_rollback = self.on_commit, [], []
+        self.write_children(dirty)
+        for action in on_commit:
+            action()
+        return None
+
+    def rollback_children(self):
+        on_rollback, self.on_commit, self.on_rollback = self.on_rollback, [], []
+        self.dirty_children = {}
+        self.children = {}
+        self.memo = {}
+        for action in on_rollback:
+            action()
+        return None
+
+    def get_child_frame(self, child, columns=None):
+        # reads a table child stored either as row dicts or as a columnar reference, projecting to columns
+        value = self.get_child_from_current(child)
+        if value is None:
+            return None
+        elif is_columnar_reference(value):
+            return columnar_store.read(value, columns)
+        df = pd.DataFrame(value)
+        if columns is not None:
+            df = df[[col for col in columns if col in df.columns]]
+        return df
+
+    def get_child_records(self, child):
+        value = self.get_child_from_current(child)
+        if is_columnar_reference(value):
+            return columnar_store.read(value).to_dict(orient='records')
+        return value
+
+    def get_table_frame(self, child):
+        # full table for server-side paging, cached per record until the child is saved again
+        key = (self.get_current_id(), child)
+        version = (self.get_child_from_current('table_versions') or {}).get(child)
+        df = table_cache.get(key, version)
+        if df is None:
+            df = self.get_child_frame(child)
+            if df is None:
+                df = pd.DataFrame()
+            if 'id' not in df.columns and len(df.columns) > 0:
+                df.insert(0, 'id', np.arange(len(df)))
+            df = table_cache.put(key, version, df)
+        return df
+
+    def get_table_page(self, child, page_current=0, page_size=TABLE_PAGE_SIZE, sort_by=None, filter_query=None):
+        df = self.get_table_frame(child)
+        if df.empty:
+            return [{}], 1
+        return get_page(df, page_current, page_size, sort_by, filter_query)
+
+    @batched
+    def patch_table_child(self, child, old_rows, new_rows):
+        # old_rows/new_rows are the page before and after an edit; only those rows are applied to the full table
+        df = apply_patch(self.get_table_frame(child), old_rows, new_rows)
+        self.save_table_child(child, df)
+        return None
+
+    @batched
+    def save_table_child(self, child, table):
+        value = None
+        previous = None
+        if columnar_store.is_enabled():
+            previous = self.get_child_from_current(child)
+            try:
+                value = columnar_store.write(table)
+            except (pa.ArrowException, ValueError, TypeError):
+                # columns of mixed types have no Arrow schema, keep those children as row dicts; a reader is
+                # already typed and, part consumed, could not be read again
+                if isinstance(table, pa.RecordBatchReader):
+                    raise
+                value = None
+        if value is None:
+            if isinstance(table, pa.RecordBatchReader):
+                # rows are built batch by batch so the Arrow table and its rows are never held together
+                value = []
+                for batch in table:
+                    value.extend(batch.to_pylist())
+            elif isinstance(table, pa.Table):
+                value = table.to_pylist()
+            elif isinstance(table, pd.DataFrame):
+                value = table.to_dict(orient='records')
+            else:
+                value = table
+        self.save_child(child, value)
+        # the old file is only deleted once the new reference is written, and the new one if it never is
+        if is_columnar_reference(previous):
+            self.on_commit.append(functools.partial(columnar_store.delete, previous))
+        if is_columnar_reference(value):
+            self.on_rollback.append(functools.partial(columnar_store.delete, value))
+
+        versions = self.get_child_from_current('table_versions') or {}
+        versions[child] = uuid.uuid4().hex
+        self.save_child('table_versions', versions)
+        if isinstance(table, pd.DataFrame):
+            table_cache.put((self.get_current_id(), child), versions[child], table)
+        return None
 
     def get_facilities_inputs_table(self):
-        table = self.get_child_from_current('facilities_inputs')
+        table = self.get_child_records('facilities_inputs')
         if table is None:
             table = [{}]
         return table
 
-    def get_facilities_inputs_table_layout(self, id_slug):
-        table = self.get_facilities_inputs_table()
-        columns = [
-            {'name': 'ID', 'id': 'id'},
-            {'name': 'Facility UID', 'id': 'facility_uid'},
-            {'name': 'Company ID', 'id': 'facility_id'},
-            {'name': 'Name', 'id': 'facility_name'},
-            {'name': 'Type', 'id': 'facility_type'},
-            {'name': 'Lat', 'id': 'lat'},
-            {'name': 'Lon', 'id': 'lon'},
-            {'name': 'Revenue share', 'id': 'revenue_share'},
-            {'name': 'Note', 'id': 'note'},
-        ]
+    def get_facilities_inputs_page(self, page_current=0, page_size=TABLE_PAGE_SIZE, sort_by=None, filter_query=None):
+        return self.get_table_page('facilities_inputs', page_current, page_size, sort_by, filter_query)
+
+    def get_facilities_inputs_table_layout(self, id_slug, lazy=False):
+        # lazy layouts start empty and are filled by the page callbacks, which run on load anyway
+        table, page_count = ([{}], 1) if lazy else self.get_facilities_inputs_page()
+        columns = self.get_facilities_inputs_columns()
         for col in columns:
             if col['id'] in ['id', 'facility_uid']:
                 col.update({'editable': False, 'hideable': True})
@@ -52,25 +337,49 @@ class KeyFacilitiesContentManager(ContentManager):
         hidden_columns = ['id', 'facility_uid', 'note']
         buttons = ['upload']
         layout = self.get_table_layout(table, columns, hidden_columns, id_slug, buttons, row_selectable=False)
+        set_custom_paging(layout, id_slug + '-table', page_count)
+        return layout
 
-        column_ids = [col['id'] for col in columns]
-        custom_columns = [col for col in table[0].keys() if col not in column_ids]
-        self.save_custom_facility_columns(custom_columns)
+    @staticmethod
+    def get_facilities_inputs_columns():
+        return [
+            {'name': 'ID', 'id': 'id'},
+            {'name': 'Facility UID', 'id': 'facility_uid'},
+            {'name': 'Company ID', 'id': 'facility_id'},
+            {'name': 'Name', 'id': 'facility_name'},
+            {'name': 'Type', 'id': 'facility_type'},
+            {'name': 'Lat', 'id': 'lat'},
+            {'name': 'Lon', 'id': 'lon'},
+            {'name': 'Revenue share', 'id': 'revenue_share'},
+            {'name': 'Note', 'id': 'note'},
+        ]
 
-        return layout
+    def parse_upload_table(self, contents, filename, uid_column=None):
+        # streaming replacement for parse_upload: base64 is decoded and parsed in chunks into an Arrow
+        # RecordBatchReader, which save_table_child writes out chunk by chunk
+        from dashboardapp.contentmanager.upload_stream import parse_upload_stream, append_upload_columns
+        error_msg, table = parse_upload_stream(contents, filename)
+        if error_msg is None:
+            table = append_upload_columns(table, uid_column)
+        return error_msg, table
 
+    @batched
     def parse_facilities_inputs_upload(self, contents, filename, last_modified):
-        error_msg, table = self.parse_upload(contents, filename, last_modified)
+        error_msg, table = self.parse_upload_table(contents, filename, uid_column='facility_uid')
         if error_msg is None:
-            for row in table:
-                row.update({'facility_uid': str(uuid.uuid4())})
-            self.save_child('facilities_inputs', table)
+            self.save_table_child('facilities_inputs', table)
+            # edits keep the columns of the table, so an upload is the only place they change
+            column_ids = [col['id'] for col in self.get_facilities_inputs_columns()]
+            self.save_custom_facility_columns([col for col in table.schema.names if col not in column_ids])
+            self.invalidate_outputs()
         else:
             self.msg = error_msg
         return None
 
+    @batched
     def save_facilities_inputs_table(self, old_table, table):
-        self.save_child('facilities_inputs', table)
+        self.patch_table_child('facilities_inputs', old_table, table)
+        self.mark_dirty_facilities(old_table, table)
         return None
 
     def save_custom_facility_columns(self, custom_columns):
@@ -78,13 +387,17 @@ class KeyFacilitiesContentManager(ContentManager):
         return None
 
     def get_production_volumes_inputs_table(self):
-        table = self.get_child_from_current('production_volumes_inputs')
+        table = self.get_child_records('production_volumes_inputs')
         if table is None:
             table = [{}]
         return table
 
-    def get_production_volumes_inputs_table_layout(self, id_slug):
-        table = self.get_production_volumes_inputs_table()
+    def get_production_volumes_inputs_page(self, page_current=0, page_size=TABLE_PAGE_SIZE, sort_by=None,
+                                           filter_query=None):
+        return self.get_table_page('production_volumes_inputs', page_current, page_size, sort_by, filter_query)
+
+    def get_production_volumes_inputs_table_layout(self, id_slug, lazy=False):
+        table, page_count = ([{}], 1) if lazy else self.get_production_volumes_inputs_page()
         columns = [
             {'name': 'ID', 'id': 'id'},
             {'name': 'Company ID', 'id': 'facility_id'},
@@ -104,23 +417,28 @@ class KeyFacilitiesContentManager(ContentManager):
         hidden_columns = ['id']
         buttons = ['upload']
         layout = self.get_table_layout(table, columns, hidden_columns, id_slug, buttons, row_selectable=False)
+        set_custom_paging(layout, id_slug + '-table', page_count)
         return layout
 
+    @batched
     def parse_production_volumes_inputs_upload(self, contents, filename, last_modified):
-        error_msg, table = self.parse_upload(contents, filename, last_modified)
+        error_msg, table = self.parse_upload_table(contents, filename)
         # add additional error checks for correct formatting etc
         if error_msg is None:
-            self.save_child('production_volumes_inputs', table)
+            self.save_table_child('production_volumes_inputs', table)
+            self.invalidate_outputs()
         else:
             self.msg = error_msg
         return None
 
+    @batched
     def save_production_volumes_inputs_table(self, old_table, table):
-        self.save_child('production_volumes_inputs', table)
+        self.patch_table_child('production_volumes_inputs', old_table, table)
+        self.invalidate_outputs()
         return None
 
     def get_product_map_inputs_table(self):
-        table = self.get_child_from_current('product_map_inputs')
+        table = self.get_child_records('product_map_inputs')
         if table is None:
             table = [{}]
         return table
@@ -148,17 +466,21 @@ class KeyFacilitiesContentManager(ContentManager):
         layout = self.get_table_layout(table, columns, hidden_columns, id_slug, buttons, row_selectable=False)
         return layout
 
+    @batched
     def parse_product_map_inputs_upload(self, contents, filename, last_modified):
-        error_msg, table = self.parse_upload(contents, filename, last_modified)
+        error_msg, table = self.parse_upload_table(contents, filename)
         # add additional error checks for correct formatting etc
         if error_msg is None:
-            self.save_child('product_map_inputs', table)
+            self.save_table_child('product_map_inputs', table)
+            self.invalidate_outputs()
         else:
             self.msg = error_msg
         return None
 
+    @batched
     def save_product_map_inputs_table(self, old_table, table):
-        self.save_child('product_map_inputs', table)
+        self.save_table_child('product_map_inputs', table)
+        self.invalidate_outputs()
         return None
 
     def get_market_breakdown_inputs_table(self):
@@ -216,81 +538,201 @@ class KeyFacilitiesContentManager(ContentManager):
 
         return layout
 
+    @batched
     def save_market_breakdown_id(self, uid):
-        self.save_child('market_breakdown_id', uid)
+        if uid != self.get_child_from_current('market_breakdown_id'):
+            self.save_child('market_breakdown_id', uid)
+            self.invalidate_outputs()
         return None
 
+    @batched
     def process_key_facilities_inputs(self):
-        facilities_inputs = self.get_child_from_current('facilities_inputs')
-        production_volumes_inputs = self.get_child_from_current('production_volumes_inputs')
-        product_map_inputs = self.get_child_from_current('product_map_inputs')
+        facilities_inputs = self.get_child_frame('facilities_inputs')
+        production_volumes_inputs = self.get_child_frame('production_volumes_inputs')
+        product_map_inputs = self.get_child_frame('product_map_inputs')
         market_breakdown_id = self.get_child_from_current('market_breakdown_id')
 
+        self.stage_timer = StageTimer()
+        df = None
         if facilities_inputs is None:
             self.msg = 'Please provide details of key facilities.'
         else:
-            df = pd.DataFrame(facilities_inputs)
-            grid_tools = GridTools(lats=df['lat'], lons=df['lon'])
-            df['grid_1deg'] = grid_tools.get_grid_ids(scale='1deg')
-            df['grid_15arcmin'] = grid_tools.get_grid_ids(scale='15arcmin')
-            df['grid_country'], self.msg = grid_tools.get_grid_countries(df['grid_1deg'], scale='1deg')
+            df = facilities_inputs
+            self.report_progress('grid', len(df))
+            # resolved once per run, both to check the saved outputs against and to compute revenues with
+            markets = None if market_breakdown_id is None else self.get_market_index(market_breakdown_id)
+            market_version = None if markets is None else markets.version
+            previous, dirty = self.get_dirty_facilities(df, market_version)
+            df = self.get_facility_grids(df, previous, dirty)
             if self.msg is None:
-                df = self.get_facility_revenues(df, production_volumes_inputs, product_map_inputs, market_breakdown_id)
-                table = df.to_dict(orient='records')
-                self.save_child('outputs', table)
+                df = self.get_facility_revenues(df, production_volumes_inputs, product_map_inputs, markets, previous,
+                                                dirty)
+                self.report_progress('save', len(df))
+                self.save_table_child('outputs', df)
+                self.save_child('unmatched_facilities', self.unmatched_facilities)
+                self.save_child('dirty_facilities', {'full': False, 'uids': []})
+                self.save_child(OUTPUTS_MARKET_VERSION_CHILD, market_version)
                 self.msg = 'Key facility inputs processed successfully.'
-        return None
-
-    def get_facility_revenues(self, df, production_volumes_inputs, product_map_inputs, market_breakdown_id):
-        if production_volumes_inputs is not None and product_map_inputs is not None and market_breakdown_id is not None:
-            cm = MarketBreakdownsContentManager()
-            cm.update_current_id(market_breakdown_id)
-            cm.make_current()
-            markets_dict = cm.get_outputs_table()
-            markets = pd.DataFrame(markets_dict)
-            volumes = pd.DataFrame(production_volumes_inputs)
-            product_map = pd.DataFrame(product_map_inputs)
-
-            df['grid_region'] = [markets.loc[(markets['country'] == i), 'region'].values[0]
-                                 if i in markets['country'].tolist() else None
-                                 for i in df['grid_country']]
-
-            volumes['facility_name_strip'] = [i[3:].lower() for i in volumes['facility_name']]
-            df['id_from_volume'] = [volumes.loc[volumes['facility_name_strip'] == i.lower(), 'facility_id'].values[0]
-                                    if i.lower() in volumes['facility_name_strip'].tolist() else None
-                                    for i in df['facility_name'].tolist()]
-
-            df['facility_id'] = [df.loc[i, 'facility_id']
-                                 if str(df.loc[i, 'facility_id']) != 'nan' else df.loc[i, 'id_from_volume']
-                                 for i in df.index]
-
-            volumes = volumes.loc[volumes['facility_id'].isin(df['facility_id'])]
-            # missing_volumes = volumes.loc[~volumes['facility_id'].isin(df['facility_id'])]  data cleaning needed
-            volumes['grid_region'] = [df.loc[df['facility_id'] == i, 'grid_region'].values[0] for i in volumes['facility_id']]
-            #volumes.loc[volumes['grid_region'].isna(), 'grid_region'] = volumes.loc[volumes['grid_region'].isna(), 'region']
-
-            regional_volumes = volumes.groupby(by=['grid_region', 'product']).agg({'volume': 'sum'})
+                if len(self.unmatched_facilities) > 0:
+                    self.msg += ' {} facilities could not be matched to production volumes.'.format(
+                        len(self.unmatched_facilities))
+                self.msg += ' ' + self.stage_timer.get_summary()
+            else:
+                df = None
+            self.stage_timer.stop()
+            record_spans(self.stage_timer.spans)
+        # the saved outputs, or None when nothing was processed and self.msg says why
+        return df
 
-            volumes['region_share'] = [volumes.loc[i, 'volume'] /
-                                       regional_volumes.loc[(volumes.loc[i, 'grid_region'], volumes.loc[i, 'product']),
-                                                         'volume'] for i in volumes.index]
+    def report_progress(self, stage, rows=None):
+        # stage is one of grid, country, reconciliation, revenue or save; background jobs may raise to cancel
+        self.stage_timer.start(stage, rows)
+        if self.progress_callback is not None:
+            self.progress_callback(stage)
+        return None
 
-            global_volumes = volumes.groupby(by=['product']).agg({'volume': 'sum'})
+    def mark_dirty_facilities(self, old_table, table):
+        dirty_facilities = self.get_child_from_current('dirty_facilities')
+        if dirty_facilities is None or dirty_facilities['full']:
+            return None
+        old_rows = {row.get('facility_uid'): row for row in old_table or []}
+        new_rows = {row.get('facility_uid'): row for row in table or []}
+        if None in old_rows or None in new_rows:
+            self.invalidate_outputs()
+        else:
+            changed = [uid for uid, row in new_rows.items() if old_rows.get(uid) != row]
+            removed = [uid for uid in old_rows if uid not in new_rows]
+            uids = sorted(set(dirty_facilities['uids']) | set(changed) | set(removed))
+            self.save_child('dirty_facilities', {'full': False, 'uids': uids})
+        return None
 
-            volumes['global_share'] = [volumes.loc[i, 'volume'] /
-                                       global_volumes.loc[volumes.loc[i, 'product'], 'volume'] for i in volumes.index]
+    def invalidate_outputs(self):
+        self.save_child('dirty_facilities', {'full': True, 'uids': []})
+        return None
 
-            df['region_assumption_revenue'] = df.apply(
-                lambda x: self.get_region_revenue(x, markets, volumes, product_map), axis=1)
-            df['global_assumption_revenue'] = df.apply(
-                lambda x: self.get_global_revenue(x, markets, volumes, product_map), axis=1)
+    def get_dirty_facilities(self, df, market_version=None):
+        # Returns the previous outputs aligned to df (or None for a full run) and a mask of rows to recompute.
+        # Also records the regions whose share denominators changed because a facility was edited or removed.
+        # market_version: version of the market index revenues are about to be computed against; outputs computed
+        # against another version of the breakdown have other regions and market sizes throughout, so they are not
+        # reused. None skips the check, for callers that only reuse the grid and match columns.
+        dirty = np.ones(len(df), dtype=bool)
+        previous = self.get_child_frame('outputs')
+        dirty_facilities = self.get_child_from_current('dirty_facilities')
+        if previous is None or dirty_facilities is None or dirty_facilities['full'] or 'facility_uid' not in df.columns:
+            return None, dirty
+        if market_version is not None and market_version != self.get_child_from_current(OUTPUTS_MARKET_VERSION_CHILD):
+            return None, dirty
+        if 'facility_uid' not in previous.columns or previous['facility_uid'].duplicated().any() \
+                or df['facility_uid'].isna().any() or df['facility_uid'].duplicated().any():
+            return None, dirty
+        # shares of a facility id are split over every row carrying it, so an edit to one row moves the others
+        if has_duplicates(df, 'facility_id') or has_duplicates(previous, 'facility_id'):
+            return None, dirty
+        if any(col not in previous.columns for col in ['facility_id', 'facility_name', 'grid_region']):
+            return None, dirty
+
+        uids = pd.Index(df['facility_uid'].to_numpy(dtype=object))
+        previous_uids = pd.Index(previous['facility_uid'].to_numpy(dtype=object))
+        positions = previous_uids.get_indexer(uids)
+        dirty = is_in(uids, dirty_facilities['uids']) | (positions < 0)
+
+        # regions of removed facilities lose a member; edited ones are compared in get_facility_revenues
+        removed = np.ones(len(previous), dtype=bool)
+        removed[positions[positions >= 0]] = False
+        self.stale_regions = set(previous.loc[removed, 'grid_region'].dropna())
+        self.facilities_removed = bool(removed.any())
+
+        previous.index = previous_uids
+        previous = previous.reindex(uids)
+        previous.index = df.index
+        return previous, dirty
+
+    def get_facility_grids(self, df, previous=None, dirty=None):
+        grid_columns = GRID_COLUMNS + ['grid_country']
+        # outputs from before the multi-resolution grid ids lack the finer scales and are regridded in full
+        if previous is None or any(col not in previous.columns for col in grid_columns):
+            return self.assign_facility_grids(df)
+        self.msg = None
+        for col in grid_columns:
+            df[col] = previous[col]
+        if dirty.any():
+            rows = self.assign_facility_grids(df.loc[dirty].reset_index(drop=True))
+            for col in grid_columns:
+                df.loc[dirty, col] = rows[col].values
+        return df
 
-            total_revenue = markets.loc[(markets['product_group'] == 'Total') &
-                                        (markets['product'] == 'Total') &
-                                        (markets['region'] == 'Total') &
-                                        (markets['sub_region'] == 'Total'), 'result'].values[0]
+    def assign_facility_grids(self, df):
+        for scale, grid_ids in get_grid_ids(df['lat'], df['lon']).items():
+            df[get_grid_column(scale)] = grid_ids
+        self.report_progress('country', len(df))
+        df['grid_country'], self.msg = self.get_grid_countries(df)
+        return df
 
-            df['input_assumption_revenue'] = total_revenue * df['revenue_share']
+    def get_grid_countries(self, df):
+        lookup = get_grid_country_lookup('1deg')
+        if lookup is None:
+            countries, fallback = np.full(len(df), None, dtype=object), np.ones(len(df), dtype=bool)
+        else:
+            # the 1deg grid ids are the lookup's cell index
+            countries, fallback = lookup.get_cell_countries(df[get_grid_column('1deg')])
+
+        msg = None
+        if fallback.any():
+            # the geometry stack behind GridTools is only loaded for border, coastal or invalid points; GridTools
+            # has its own cell ids, so it is given the coordinates
+            from dashboardapp.calculationmanager.grid_tools import GridTools
+            rows = df.loc[fallback]
+            grid_tools = GridTools(lats=rows['lat'].reset_index(drop=True), lons=rows['lon'].reset_index(drop=True))
+            fallback_countries, msg = grid_tools.get_grid_countries(grid_tools.get_grid_ids(scale='1deg'), scale='1deg')
+            countries[fallback] = list(fallback_countries)
+        return list(countries), msg
+
+    def get_facility_revenues(self, df, production_volumes_inputs, product_map_inputs, markets, previous=None,
+                              dirty=None):
+        # markets: MarketIndex of the selected breakdown, or None when none is selected
+        # previous/dirty: outputs of the last run aligned to df and the rows to recompute, see get_dirty_facilities
+        if production_volumes_inputs is not None and product_map_inputs is not None and markets is not None:
+            volumes = pd.DataFrame(production_volumes_inputs)
+            product_map = pd.DataFrame(product_map_inputs)
+            if previous is None:
+                dirty = np.ones(len(df), dtype=bool)
+
+            df['grid_region'] = markets.get_regions(df['grid_country'])
+            df = self.reconcile_facilities(df, volumes, previous, dirty)
+
+            # Revenues of a facility only move with its id or region, or with the members of its region (region
+            # shares) or of the whole portfolio (global shares). An edit that changes neither, e.g. a moved point
+            # in the same country, recomputes nothing.
+            region_rows = np.ones(len(df), dtype=bool)
+            global_rows = np.ones(len(df), dtype=bool)
+            if previous is not None:
+                id_changed = dirty & has_changed(df['facility_id'], previous['facility_id'])
+                changed = id_changed | (dirty & has_changed(df['grid_region'], previous['grid_region']))
+                stale_regions = self.stale_regions | set(df.loc[changed, 'grid_region'].dropna()) | \
+                    set(previous.loc[changed, 'grid_region'].dropna())
+                region_rows = changed | is_in(df['grid_region'], list(stale_regions))
+                global_rows[:] = self.facilities_removed or id_changed.any()
+                for col in ['region_assumption_revenue', 'global_assumption_revenue']:
+                    df[col] = previous[col]
+
+            self.report_progress('revenue', int((region_rows | global_rows).sum()))
+            if global_rows.any():
+                volumes = self.get_volume_shares(df, volumes)
+            elif region_rows.any():
+                # region shares only need the facilities of the regions being recomputed
+                regions = df.loc[region_rows, 'grid_region'].dropna().unique()
+                volumes = self.get_volume_shares(df.loc[is_in(df['grid_region'], regions)], volumes)
+
+            if region_rows.any() or global_rows.any():
+                from dashboardapp.calculationmanager.revenue_engine import RevenueEngine
+                engine = RevenueEngine(markets, volumes, product_map)
+                df.loc[region_rows, 'region_assumption_revenue'] = engine.get_region_revenues(
+                    df.loc[region_rows, 'facility_id'], df.loc[region_rows, 'grid_region'])
+                df.loc[global_rows, 'global_assumption_revenue'] = engine.get_global_revenues(
+                    df.loc[global_rows, 'facility_id'])
+            # as RevenueEngine.get_input_revenues, which needs no volumes
+            df['input_assumption_revenue'] = markets.get_total_revenue() * df['revenue_share']
 
         else:
             df['region_assumption_revenue'] = np.nan
@@ -299,53 +741,159 @@ class KeyFacilitiesContentManager(ContentManager):
 
         return df
 
-    def get_region_revenue(self, row, markets, volumes, product_map):
-        facility_id = row['facility_id']
-        region = row['grid_region']
-        if facility_id in volumes['facility_id'].tolist():
-            products = volumes.loc[volumes['facility_id'] == facility_id, ['product', 'region_share']]
-            revenue = 0
-            for i in products.index:
-                product = products.loc[i, 'product']
-                share = products.loc[i, 'region_share']
-                end_products = product_map.loc[product_map['product'] == product]
-                end_products['region_revenue'] = [markets.loc[(markets['product'] == i) &
-                                                             (markets['region'] == region) &
-                                                             (markets['sub_region'] == 'Total'), 'result'].values[0]
-                                                  for i in end_products['end_product']]
-                end_products['revenue'] = end_products['region_revenue'] * (end_products['share'] / 100) * share
-                revenue += end_products['revenue'].sum()
-        else:
-            revenue = 0
-        return revenue
-
-    def get_global_revenue(self, row, markets, volumes, product_map):
-        facility_id = row['facility_id']
-        if facility_id in volumes['facility_id'].tolist():
-            products = volumes.loc[volumes['facility_id'] == facility_id, ['product', 'global_share']]
-            revenue = 0
-            for i in products.index:
-                product = products.loc[i, 'product']
-                share = products.loc[i, 'global_share']
-                end_products = product_map.loc[product_map['product'] == product]
-                end_products['global_revenue'] = [markets.loc[(markets['product'] == i) &
-                                                             (markets['region'] == 'Total') &
-                                                             (markets['sub_region'] == 'Total'), 'result'].values[0]
-                                                  for i in end_products['end_product']]
-                end_products['revenue'] = end_products['global_revenue'] * (end_products['share'] / 100) * share
-                revenue += end_products['revenue'].sum()
-        else:
-            revenue = 0
-        return revenue
+    def reconcile_facilities(self, df, volumes, previous=None, dirty=None):
+        if dirty is None:
+            dirty = np.ones(len(df), dtype=bool)
+        match_columns = ['facility_id', 'id_from_volume', 'id_match_confidence']
+        missing_ids = dirty & df['facility_id'].isna().values
+        # an edited row keeping its id and name keeps its match; only missing ids and new names need the volumes
+        matched = dirty.copy()
+        if previous is not None and all(col in previous.columns for col in match_columns + ['facility_name']):
+            for col in match_columns:
+                df.loc[~dirty, col] = previous.loc[~dirty, col]
+            matched = missing_ids | (dirty & has_changed(df['facility_name'], previous['facility_name']))
+            kept = dirty & ~matched
+            df.loc[kept, 'id_from_volume'] = previous.loc[kept, 'id_from_volume']
+            df.loc[kept, 'id_match_confidence'] = np.nan
+        elif previous is not None:
+            for col in match_columns:
+                if col in previous.columns:
+                    df.loc[~dirty, col] = previous.loc[~dirty, col]
+
+        self.report_progress('reconciliation', int(matched.sum()))
+        if matched.any():
+            reconciler = self.get_reconciler(volumes)
+            matches = reconciler.reconcile(df.loc[matched, 'facility_name'], fuzzy=missing_ids[matched],
+                                           claimed=df.loc[~missing_ids, 'facility_id'].dropna())
+            df.loc[matched, 'id_from_volume'] = matches['id_from_volume'].values
+            df.loc[matched, 'id_match_confidence'] = matches['id_match_confidence'].where(missing_ids[matched]).values
+        df.loc[missing_ids, 'facility_id'] = df.loc[missing_ids, 'id_from_volume']
+
+        unmatched = df.loc[df['facility_id'].isna()]
+        report_columns = [col for col in ['facility_uid', 'facility_name'] if col in df.columns]
+        self.unmatched_facilities = unmatched[report_columns].to_dict(orient='records')
+        return df
 
-    def get_outputs_table(self):
-        table = self.get_child_from_current('outputs')
-        if table is None:
-            table = [{}]
-        return table
+    def get_reconciler(self, volumes):
+        # volumes as saved for the current record, whose table version keys the cached reconciler
+        version = (self.get_child_from_current('table_versions') or {}).get('production_volumes_inputs')
+        return get_reconciler(None if version is None else (self.get_current_id(), version), volumes)
+
+    @staticmethod
+    def get_volume_shares(df, volumes):
+        # shares of each facility in the production of its grid region and of the world, per product
+        volumes = volumes.loc[is_in(volumes['facility_id'], df['facility_id'])].copy()
+        # missing_volumes = volumes.loc[~volumes['facility_id'].isin(df['facility_id'])]  data cleaning needed
+        facility_regions = df.drop_duplicates(subset=['facility_id']).set_index('facility_id')['grid_region']
+        volumes['grid_region'] = volumes['facility_id'].map(facility_regions)
+        #volumes.loc[volumes['grid_region'].isna(), 'grid_region'] = volumes.loc[volumes['grid_region'].isna(), 'region']
+
+        volumes['region_share'] = volumes['volume'] / volumes.groupby(by=['grid_region', 'product'])['volume'].transform('sum')
+        volumes['global_share'] = volumes['volume'] / volumes.groupby(by=['product'])['volume'].transform('sum')
+        return volumes
+
+    def sweep_market_breakdowns(self, market_breakdown_ids):
+        # Facility x scenario revenues against several market breakdowns without saving anything. Grids, name
+        # reconciliation and global shares are computed once; region shares once per distinct country -> region
+        # mapping. Returns None with self.msg set when the inputs are incomplete.
+        facilities_inputs = self.get_child_frame('facilities_inputs')
+        production_volumes_inputs = self.get_child_frame('production_volumes_inputs')
+        product_map_inputs = self.get_child_frame('product_map_inputs')
+
+        self.stage_timer = StageTimer(run='key_facilities_sweep')
+        if facilities_inputs is None or production_volumes_inputs is None or product_map_inputs is None:
+            self.msg = 'Please provide key facilities, production volumes and a product map.'
+            return None
+        if len(market_breakdown_ids) == 0:
+            self.msg = 'Please select at least one market breakdown.'
+            return None
+
+        df = facilities_inputs
+        self.report_progress('grid', len(df))
+        # grid and match columns of the last Process run do not depend on the market breakdown, so they are reused
+        previous, dirty = self.get_dirty_facilities(df)
+        df = self.get_facility_grids(df, previous, dirty)
+        if self.msg is not None:
+            return None
+        volumes = pd.DataFrame(production_volumes_inputs)
+        product_map = pd.DataFrame(product_map_inputs)
+        df = self.reconcile_facilities(df, volumes, previous, dirty)
+
+        self.report_progress('revenue', len(df) * len(market_breakdown_ids))
+        markets = [self.get_market_index(market_breakdown_id) for market_breakdown_id in market_breakdown_ids]
+        region_groups = OrderedDict()
+        for scenario, market_index in enumerate(markets):
+            region_groups.setdefault(tuple(market_index.get_regions(df['grid_country'])), []).append(scenario)
+
+        scenario_volumes = None
+        for group, regions in enumerate(region_groups):
+            df['grid_region'] = list(regions)
+            shares = self.get_volume_shares(df, volumes)
+            if scenario_volumes is None:
+                scenario_volumes = shares
+            scenario_volumes['region_share_{}'.format(group)] = shares['region_share'].values
+
+        from dashboardapp.calculationmanager.revenue_engine import ScenarioRevenueEngine
+        engine = ScenarioRevenueEngine(markets, scenario_volumes, product_map)
+        region_revenues = np.zeros((len(df), len(markets)))
+        for group, (regions, scenarios) in enumerate(region_groups.items()):
+            region_revenues[:, scenarios] = engine.get_region_revenues(
+                df['facility_id'], regions, scenarios, 'region_share_{}'.format(group))
+        sweep = {
+            'market_breakdown_ids': list(market_breakdown_ids),
+            'facilities': df.drop(columns=['grid_region']),
+            'region_assumption_revenue': region_revenues,
+            'global_assumption_revenue': engine.get_global_revenues(df['facility_id']),
+            'input_assumption_revenue': engine.get_input_revenues(df['revenue_share']),
+        }
+        self.msg = 'Revenues computed for {} market breakdowns. {}'.format(len(markets),
+                                                                           self.stage_timer.get_summary())
+        record_spans(self.stage_timer.spans)
+        return sweep
+
+    @staticmethod
+    def get_sweep_frame(sweep, revenue_option=MAP_REVENUE_OPTION):
+        # one column per market breakdown for comparison tables; with revenue_options set to the breakdown ids,
+        # make_map_data turns the same frame into a map whose basis selector switches between scenarios
+        df = sweep['facilities'].copy()
+        revenues = sweep[revenue_option]
+        for scenario, market_breakdown_id in enumerate(sweep['market_breakdown_ids']):
+            df[market_breakdown_id] = revenues[:, scenario]
+        return df
+
+    def get_market_index(self, market_breakdown_id):
+        version = self.get_market_breakdown_version(market_breakdown_id)
+        return get_market_index(market_breakdown_id, self.load_market_breakdown_outputs, version)
+
+    def get_market_breakdown_version(self, market_breakdown_id):
+        # when the breakdown record was last saved, read from the record table rather than loading and hashing its
+        # outputs; None when the record is not listed, in which case the index cache versions the outputs by content
+        cm = MarketBreakdownsContentManager()
+        cm.enumerate_active()
+        for row in cm.get_record_table(cm.active):
+            if row.get('id') == market_breakdown_id and row.get(RECORD_MODIFIED_COLUMN) is not None:
+                return '{}:{}'.format(RECORD_MODIFIED_COLUMN, row[RECORD_MODIFIED_COLUMN])
+        return None
+
+    def load_market_breakdown_outputs(self, market_breakdown_id):
+        cm = MarketBreakdownsContentManager()
+        cm.update_current_id(market_breakdown_id)
+        cm.make_current()
+        return cm.get_outputs_table()
 
-    def get_outputs_table_layout(self, id_slug):
-        table = self.get_outputs_table()
+    def get_outputs_table(self):
+        if 'outputs' not in self.memo:
+            table = self.get_child_records('outputs')
+            if table is None:
+                table = [{}]
+            self.memo['outputs'] = table
+        return self.memo['outputs']
+
+    def get_outputs_page(self, page_current=0, page_size=TABLE_PAGE_SIZE, sort_by=None, filter_query=None):
+        return self.get_table_page('outputs', page_current, page_size, sort_by, filter_query)
+
+    def get_outputs_table_layout(self, id_slug, lazy=False):
+        table, page_count = ([{}], 1) if lazy else self.get_outputs_page()
         columns = [
             {'name': 'ID', 'id': 'id'},
             {'name': 'Facility UID', 'id': 'facility_uid'},
@@ -354,15 +902,19 @@ class KeyFacilitiesContentManager(ContentManager):
             {'name': 'Type', 'id': 'facility_type'},
             {'name': 'Lat', 'id': 'lat'},
             {'name': 'Lon', 'id': 'lon'},
-            {'name': '1deg grid ID', 'id': 'grid_1deg'},
-            {'name': '15arcmin grid ID', 'id': 'grid_15arcmin'},
+            {'name': '1deg grid ID', 'id': get_grid_column('1deg')},
+            {'name': '30arcmin grid ID', 'id': get_grid_column('30arcmin')},
+            {'name': '15arcmin grid ID', 'id': get_grid_column('15arcmin')},
+            {'name': '5arcmin grid ID', 'id': get_grid_column('5arcmin')},
+            {'name': 'ID match confidence', 'id': 'id_match_confidence'},
             {'name': 'Revenue (input)', 'id': 'input_assumption_revenue'},
             {'name': 'Revenue (region)', 'id': 'region_assumption_revenue'},
             {'name': 'Revenue (global)', 'id': 'global_assumption_revenue'},
             {'name': 'Note', 'id': 'note'},
         ]
         for col in columns:
-            if col['id'] in ['id', 'facility_uid', 'facility_id', 'facility_name', 'facility_type', 'grid_1deg', 'grid_15arcmin', 'note']:
+            if col['id'] in ['id', 'facility_uid', 'facility_id', 'facility_name', 'facility_type', 'note'] + \
+                    GRID_COLUMNS:
                 col.update({'editable': False, 'hideable': True})
             elif col['id'] in ['revenue']:
                 col.update({'editable': False, 'hideable': True, 'type': 'numeric',
@@ -371,124 +923,108 @@ class KeyFacilitiesContentManager(ContentManager):
                 col.update({'editable': False, 'hideable': True, 'type': 'numeric',
                             'format': Format(precision=5, scheme=Scheme.fixed)})
 
-        hidden_columns = ['id', 'facility_uid', 'note']
+        hidden_columns = ['id', 'facility_uid', get_grid_column('30arcmin'), get_grid_column('5arcmin'), 'note']
         buttons = []
         layout = self.get_table_layout(table, columns, hidden_columns, id_slug, buttons, row_selectable=False)
+        set_custom_paging(layout, id_slug + '-table', page_count)
         return layout
 
-    def get_map_layout(self, id_slug):
-        figure = self.get_map_figure()
+    def get_map_layout(self, id_slug, lazy=False):
+        figure = self.get_map_figure(lazy)
         layout = html.Div([
-            dcc.Graph(
-                id=id_slug + '-chart',
-                figure=figure,
-                config=self.map_fig_config(),
-                style={'position': 'absolute', 'top': 0, 'left': 0, 'bottom': 0, 'right': 0}
+            dcc.RadioItems(
+                id=id_slug + '-revenue-basis',
+                options=MAP_REVENUE_OPTIONS,
+                value=MAP_REVENUE_OPTION,
+                labelStyle={'display': 'inline-block', 'margin-right': '10px'},
             ),
-        ], id=id_slug + '-chart-container', style={'width': '100%', 'padding-top': '70%', 'position': 'relative'})
-        return layout
-
-    def get_map_data(self, revenue_option='global_assumption_revenue'):
-        table = self.get_outputs_table()
-        df = pd.DataFrame(table)
-        if not df.empty:
-
-            facility_type = list(df['facility_type'].unique())
-            reverse_scale = False
-            cl_scale = cl.scales['9']['div']['Spectral']
-            # cl_scale = cl.scales['9']['seq']['Reds']
-            if reverse_scale:
-                color_scale = cl.to_numeric(list(reversed(cl_scale)))  # Spectral RdYlBu
-            else:
-                color_scale = cl.to_numeric(list(cl_scale))
-            color_scale = [tuple(map(lambda x: x / 255, color)) for color in color_scale]
-            n_levels = len(facility_type)
-            color_map = LinearSegmentedColormap.from_list('my_list', color_scale, n_levels)
-            color_scale = {facility_type[i]: 'rgb' + str(tuple(map(lambda x: x * 255, color_map(i / n_levels)))[:-1])
-                           for i in range(n_levels)}
-
-            df['revenue'] = df[revenue_option]
-
-            if df['revenue'].max() not in [0, np.nan]:
-                df['revenue_scale'] = 10 + (df['revenue'] / df['revenue'].max()) * 40
-            else:
-                df['revenue_scale'] = 10
-
-            data = [dict(
-                type='scattermapbox',
-                lon=df.loc[df['facility_type'] == facility_type, 'lon'],
-                lat=df.loc[df['facility_type'] == facility_type, 'lat'],
-                mode='markers',
-                marker=dict(
-                    color=color_scale[facility_type],
-                    size=df.loc[df['facility_type'] == facility_type, 'revenue_scale'],
-                    opacity=0.8,
+            # figures built by the server land here and are restyled for the selected basis in the browser
+            dcc.Store(id=id_slug + '-figure'),
+            html.Div([
+                dcc.Graph(
+                    id=id_slug + '-chart',
+                    figure=figure,
+                    config=self.map_fig_config(),
+                    style={'position': 'absolute', 'top': 0, 'left': 0, 'bottom': 0, 'right': 0}
                 ),
-                text=['{}'.format(df.loc[i, 'facility_name']) + '<br>' +
-                      'Revenue: {:.2f} m CHF'.format(df.loc[i, 'revenue'])
-                      for i in df.loc[df['facility_type'] == facility_type].index],
-                hoverinfo='text',
-                hoverlabel={'namelength': -1},
-                name=facility_type,
-                showlegend=True,
-            ) for facility_type in facility_type]  # if facility_type == 'PL: Production Plants'
-
-            if 'grid_15arcmin' in df.columns:
-                df['grid_polygon'] = GridTools().get_grid_polygons(grid_ids=df['grid_15arcmin'], scale='15arcmin')
-            else:
-                df['grid_polygon'] = GridTools().get_grid_polygons(grid_ids=df['grid_1deg'])
-
-            grid_polygons = list(df['grid_polygon'])
-            union = unary_union(grid_polygons)
-            grid_geojson = geojson.Feature(geometry=union, properties={}, id='1')
-            grid_geojson = {'type': 'FeatureCollection', 'features': [grid_geojson]}
-
-            data += [dict(
-                type='choroplethmapbox',
-                geojson=grid_geojson,
-                locations=['1'],
-                z=[1],
-                name='grid',
-                colorscale='Viridis',
-                zmin=0,
-                zmax=10,
-                marker_line_width=0,
-                showlegend=True,
-                visible='legendonly',
-                showscale=False,
-                marker_opacity=0.5,
-            )]
-        else:
-            data = self.get_empty_scattermapbox_data()
-        return data
-
-    def get_map_figure(self):
-
-        data = self.get_map_data()
-
-        zoom_level = 0.8
-        lat_center = 73.3 - 57.9
-
-        layout = dict(
-            mapbox={
-                'style': 'light',#'open-street-map',  # 'stamen-terrain' 'white-bg', 'satellite' 'carto-positron, carto-darkmatter, stamen-terrain, stamen-toner, stamen-watercolor
-                'center': go.layout.mapbox.Center(lat=lat_center, lon=0),
-                'zoom': zoom_level,
-                'accesstoken': MAPBOX_ACCESS_TOKEN
-            },
-            margin={'l': 0, 'r': 0, 'b': 0, 't': 0},
-            legend={
-                'orientation': 'h',
-                'xanchor': 'right',
-                'x': 1,
-                'yanchor': 'bottom',
-                'y': 1,
-            },
-        )
+            ], id=id_slug + '-chart-container', style={'width': '100%', 'padding-top': '70%', 'position': 'relative'}),
+        ])
+        return layout
 
-        figure = go.Figure(
-            data=data,
-            layout=layout,
-        )
+    @staticmethod
+    def get_map_cluster_column(zoom):
+        for max_zoom, cluster_column in MAP_CLUSTER_BANDS:
+            if zoom < max_zoom:
+                return cluster_column
+        return None
 
-        return figure
+    @staticmethod
+    def get_map_view(relayout_data):
+        # [west, south, east, north] of the view plotly reports with a pan or zoom, or None when it reports none
+        coordinates = ((relayout_data or {}).get('mapbox._derived') or {}).get('coordinates')
+        if not coordinates:
+            return None
+        lons = [coordinate[0] for coordinate in coordinates]
+        lats = [coordinate[1] for coordinate in coordinates]
+        return [min(lons), min(lats), max(lons), max(lats)]
+
+    @staticmethod
+    def get_map_bounds(view):
+        # the area loaded for a view, padded on every side; None loads the whole map
+        if view is None:
+            return None
+        west, south, east, north = view
+        lon_padding = (east - west) * MAP_BOUNDS_PADDING
+        lat_padding = (north - south) * MAP_BOUNDS_PADDING
+        west, east = west - lon_padding, east + lon_padding
+        if east - west >= 360:
+            west, east = -180, 180
+        return [west, max(south - lat_padding, -90), east, min(north + lat_padding, 90)]
+
+    @staticmethod
+    def is_view_loaded(view, bounds):
+        # an unknown view keeps what is loaded
+        if bounds is None or view is None:
+            return True
+        # both corners of the view inside the loaded area, and the view no wider than it
+        west, south, east, north = view
+        corners = is_in_bounds([south, north], [west, east], bounds)
+        return bool(corners.all()) and (bounds[2] - bounds[0] >= 360 or east - west <= bounds[2] - bounds[0])
+
+    def get_map_data(self, revenue_option=MAP_REVENUE_OPTION, include_grid=False, cluster_column=None, bounds=None):
+        key = ('map_data', revenue_option, include_grid, cluster_column, None if bounds is None else tuple(bounds))
+        if key not in self.memo:
+            self.memo[key] = self.make_map_data(revenue_option, include_grid, cluster_column, bounds)
+        return self.memo[key]
+
+    def make_map_data(self, revenue_option, include_grid, cluster_column=None, bounds=None):
+        # bounds: [west, south, east, north] of the area to draw, see get_map_bounds; None draws every facility
+        revenue_options = [option['value'] for option in MAP_REVENUE_OPTIONS]
+        columns = ['lat', 'lon', 'facility_type', 'facility_name'] + revenue_options
+        if revenue_option not in columns:
+            columns.append(revenue_option)
+        if include_grid or cluster_column:
+            columns += GRID_COLUMNS
+        df = self.get_child_frame('outputs', columns=columns)
+        if df is None or df.empty:
+            return self.get_empty_scattermapbox_data()
+        if (include_grid or cluster_column) and any(col not in df.columns for col in GRID_COLUMNS):
+            # outputs processed before the multi-resolution grid ids carry other ids; one pass gives every scale
+            for scale, grid_ids in get_grid_ids(df['lat'], df['lon']).items():
+                df[get_grid_column(scale)] = grid_ids
+        # types of the whole portfolio, so colours and trace order stay put as the view moves
+        facility_types = tuple(df['facility_type'].dropna().unique())
+        if bounds is not None:
+            df = df.loc[is_in_bounds(df['lat'], df['lon'], bounds)]
+        # the colormap, geometry and figure libraries are only imported once a map is first built
+        from dashboardapp.contentmanager.digital_twin_key_facilities_maps import make_map_data
+        return make_map_data(df, revenue_option, include_grid, cluster_column, revenue_options, bounds, facility_types)
+
+    def get_map_figure(self, lazy=False):
+        if lazy:
+            # the page callbacks fill the map on load; until then an empty figure dict keeps the map libraries unloaded
+            return {'data': [{'type': 'scattermapbox', 'lat': [], 'lon': [], 'mode': 'markers'}],
+                    'layout': make_map_layout(MAP_ZOOM, MAPBOX_ACCESS_TOKEN)}
+        from dashboardapp.contentmanager.digital_twin_key_facilities_maps import make_map_figure
+        data = self.get_map_data(cluster_column=self.get_map_cluster_column(MAP_ZOOM))
+        return make_map_figure(data, MAP_ZOOM, MAPBOX_ACCESS_TOKEN)
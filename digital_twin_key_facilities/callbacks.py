@@ -1,11 +1,96 @@
+import time
+
+from dash import callback_context, no_update
 from dash.dependencies import Input, Output, State
 
 from dashboardapp.plotlydashapp.pages.page import RegisterBase
 from dashboardapp.store_manager import StoreManager
 from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
 from dashboardapp.docmanager.digital_twin_key_facilities_docs import KeyFacilitiesDocManager
-from dashboardapp.plotlydashapp.pages.digital_twin.digital_twin_key_facilities import content
-
+from dashboardapp.contentmanager.digital_twin_key_facilities_jobs import job_runner, JOB_FINISHED
+from dashboardapp.instrumentation import record_spans
+from .content import MESSAGE_SOURCES
+
+
+# shows the message of the store that triggered, hides the popup on dismiss or when that callback had nothing to say
+MSG_POPUP_FUNCTION = '''
+function() {
+    var triggered = dash_clientside.callback_context.triggered;
+    if (!triggered || triggered.length === 0) {
+        return [dash_clientside.no_update, dash_clientside.no_update];
+    }
+    if (triggered[0].prop_id.indexOf('dismiss-popup-button') !== -1) {
+        return [{'display': 'none'}, ''];
+    }
+    // a callback without a message leaves the popup as it is, so it cannot hide another callback's message
+    var data = triggered[0].value;
+    if (!data || !data.msg) {
+        return [dash_clientside.no_update, dash_clientside.no_update];
+    }
+    return [{'display': 'block'}, data.msg];
+}
+'''
+
+# puts a figure from the server, or the one on screen when the basis changes, on the selected revenue basis using
+# the revenues every trace carries in meta; marker sizes are worked out here as get_marker_sizes does on the server
+REVENUE_BASIS_FUNCTION = '''
+function(figure, basis, current) {
+    var triggered = dash_clientside.callback_context.triggered;
+    var source = figure;
+    if (triggered && triggered.length > 0 && triggered[0].prop_id.indexOf('-revenue-basis') !== -1) {
+        source = current;
+    }
+    if (!source || !source.data) {
+        return dash_clientside.no_update;
+    }
+    // arrays come as plain lists, or as {dtype, bdata} when encode_map_array ships typed arrays
+    function decode(values) {
+        if (!values || !values.bdata) {
+            return values || [];
+        }
+        var bytes = atob(values.bdata);
+        var buffer = new Uint8Array(bytes.length);
+        for (var i = 0; i < bytes.length; i++) {
+            buffer[i] = bytes.charCodeAt(i);
+        }
+        return values.dtype === 'f4' ? new Float32Array(buffer.buffer) : new Float64Array(buffer.buffer);
+    }
+    var revenues = source.data.map(function(trace) {
+        var revenue = trace.meta && trace.meta.revenue && trace.meta.revenue[basis];
+        return revenue && trace.type !== 'choroplethmapbox' ? decode(revenue) : null;
+    });
+    // markers are sized against the largest revenue of any trace
+    var max = 0;
+    revenues.forEach(function(values) {
+        for (var i = 0; values && i < values.length; i++) {
+            if (values[i] > max) {
+                max = values[i];
+            }
+        }
+    });
+    var data = source.data.map(function(trace, t) {
+        var revenue = trace.meta && trace.meta.revenue && trace.meta.revenue[basis];
+        if (!revenue) {
+            return trace;
+        }
+        var restyled = Object.assign({}, trace);
+        if (trace.type === 'choroplethmapbox') {
+            restyled.z = revenue.z;
+            restyled.zmax = revenue.zmax;
+        } else {
+            var values = revenues[t];
+            var size = new Array(values.length);
+            for (var i = 0; i < values.length; i++) {
+                size[i] = max > 0 ? 10 + values[i] / max * 40 : 10;
+            }
+            restyled.marker = Object.assign({}, trace.marker, {'size': size});
+            restyled.customdata = revenue;
+        }
+        return restyled;
+    });
+    return Object.assign({}, source, {'data': data});
+}
+'''
 
 
 class Register(RegisterBase):
@@ -23,6 +108,7 @@ class Register(RegisterBase):
         self.doc_inputs_table_id = 'doc-inputs'
         self.key_facilities_revenue_table_id = 'key-facilities-revenue'
         self.key_facilities_revenue_map_id = 'key-facilities-revenue-map'
+        self.solver_id = 'solver'
 
         self.make_toggle_popover_callbacks([
             self.data_selector_table_id,
@@ -55,6 +141,7 @@ class Register(RegisterBase):
             [Output(page_module_name + self.doc_selector_table_id + '-table', 'data'),
              Output(page_module_name + self.doc_selector_table_id + '-table', 'selected_rows'),
              Output(page_module_name + self.doc_selector_table_id + '-table', 'selected_row_ids'),
+             self.get_msg_output(self.doc_selector_table_id),
              ],
             [Input(page_module_name + self.data_selector_table_id + '-table', 'selected_row_ids'),
              Input(page_module_name + self.doc_selector_table_id + '-new-button', 'n_clicks'),
@@ -100,55 +187,47 @@ class Register(RegisterBase):
             new_table = dm.get_record_table(dm.active)
             new_selected_ids = [dm.get_current_id()]
             new_selected_rows = dm.get_record_selected_rows(new_table)
-            dm.save_msg()
-
-            return new_table, new_selected_rows, new_selected_ids
-
-        # move callback to RegisterBase passing in any additional inputs?
-        @app.callback([Output(page_module_name + 'message-popup', 'style'),
-                       Output(page_module_name + 'message-text', 'children')],
-                      [Input(page_module_name + 'dismiss-popup-button', 'n_clicks'),
-                       Input(page_module_name + self.data_selector_table_id + '-table', 'data'),
-                       Input(page_module_name + self.facilities_table_id + '-table', 'data'),
-                       Input(page_module_name + self.production_volumes_table_id + '-table', 'data'),
-                       Input(page_module_name + self.product_map_table_id + '-table', 'data'),
-                       Input(page_module_name + self.market_breakdown_table_id + '-table', 'data'),
-                       Input(page_module_name + self.outputs_table_id + '-table', 'data'),
-                       Input(page_module_name + self.key_facilities_revenue_table_id + '-table', 'data'),
-                       Input(page_module_name + self.doc_selector_table_id + '-table', 'data'),
-                       Input(page_module_name + self.doc_inputs_table_id + '-table', 'data'),
-                       ],
-                      )
-        def msg_popup(dismiss_button, table_1, table_2, table_3, table_4, table_5, table_6, table_7, table_8, table_9):
-            cm = StoreManager('status')
-            trigger_dict = self.get_trigger(self.page_module_name)
-            if trigger_dict['component'] == 'dismiss-popup-button':
-                popup_style = {'display': 'none'}
-                message_text = ''
-            else:
-                latest_msg = cm.status['data_manager_msg']
-                if latest_msg is not None:
-                    popup_style = {'display': 'block'}
-                    message_text = latest_msg
-                    cm.clear_msg()
-                else:
-                    popup_style = {'display': 'none'}
-                    message_text = ''
 
-            return popup_style, message_text
+            return new_table, new_selected_rows, new_selected_ids, self.get_msg_data(dm.msg)
+
+        # the data selector callbacks live in RegisterBase and still leave their message in the status store
+        @app.callback(self.get_msg_output(self.data_selector_table_id),
+                      [Input(page_module_name + self.data_selector_table_id + '-table', 'data')])
+        def selector_msg(table):
+            sm = StoreManager('status')
+            msg = sm.status['data_manager_msg']
+            if msg is not None:
+                sm.clear_msg()
+            return self.get_msg_data(msg)
+
+        # every other callback returns its message in a store of its own, so showing or hiding the popup needs no
+        # server round-trip
+        app.clientside_callback(
+            MSG_POPUP_FUNCTION,
+            [Output(page_module_name + 'message-popup', 'style'),
+             Output(page_module_name + 'message-text', 'children')],
+            [Input(page_module_name + 'dismiss-popup-button', 'n_clicks')] +
+            [Input(page_module_name + source_id + '-msg', 'data') for source_id in MESSAGE_SOURCES],
+        )
 
         @app.callback(
             [Output(page_module_name + self.facilities_table_id + '-table', 'data'),
+             Output(page_module_name + self.facilities_table_id + '-table', 'page_count'),
+             self.get_msg_output(self.facilities_table_id),
              ],
             [Input(page_module_name + self.data_selector_table_id + '-table', 'selected_row_ids'),
              Input(page_module_name + self.facilities_table_id + '-upload-data', 'contents'),
              Input(self.page_module_name + self.facilities_table_id + '-table', 'data_previous'),
+             Input(page_module_name + self.facilities_table_id + '-table', 'page_current'),
+             Input(page_module_name + self.facilities_table_id + '-table', 'page_size'),
+             Input(page_module_name + self.facilities_table_id + '-table', 'sort_by'),
+             Input(page_module_name + self.facilities_table_id + '-table', 'filter_query'),
              ],
             [State(page_module_name + self.facilities_table_id + '-upload-data', 'filename'),
              State(page_module_name + self.facilities_table_id + '-upload-data', 'last_modified'),
              State(self.page_module_name + self.facilities_table_id + '-table', 'data'),
              ])
-        def update_inputs_table(parent_ids, upload_contents, old_table,
+        def update_inputs_table(parent_ids, upload_contents, old_table, page_current, page_size, sort_by, filter_query,
                                 upload_filename, upload_last_modified, table):
             trigger_dict = self.get_trigger(self.page_module_name)
             cm = KeyFacilitiesContentManager()
@@ -160,25 +239,31 @@ class Register(RegisterBase):
                     cm.make_current()
             elif '-upload-data' in trigger_dict['component']:
                 cm.parse_facilities_inputs_upload(upload_contents, upload_filename, upload_last_modified)
-            elif 'table' in trigger_dict['component']:
+            elif self.get_trigger_property() == 'data_previous':
+                # data/data_previous only hold the current page, so the edit is applied as a row patch
                 cm.save_facilities_inputs_table(old_table, table)
 
-            new_table = cm.get_facilities_inputs_table()
-            cm.save_msg()
-            return [new_table]
+            new_table, page_count = cm.get_facilities_inputs_page(page_current, page_size, sort_by, filter_query)
+            return [new_table, page_count, self.get_msg_data(cm.msg)]
 
         @app.callback(
             [Output(page_module_name + self.production_volumes_table_id + '-table', 'data'),
+             Output(page_module_name + self.production_volumes_table_id + '-table', 'page_count'),
+             self.get_msg_output(self.production_volumes_table_id),
              ],
             [Input(page_module_name + self.data_selector_table_id + '-table', 'selected_row_ids'),
              Input(page_module_name + self.production_volumes_table_id + '-upload-data', 'contents'),
              Input(self.page_module_name + self.production_volumes_table_id + '-table', 'data_previous'),
+             Input(page_module_name + self.production_volumes_table_id + '-table', 'page_current'),
+             Input(page_module_name + self.production_volumes_table_id + '-table', 'page_size'),
+             Input(page_module_name + self.production_volumes_table_id + '-table', 'sort_by'),
+             Input(page_module_name + self.production_volumes_table_id + '-table', 'filter_query'),
              ],
             [State(page_module_name + self.production_volumes_table_id + '-upload-data', 'filename'),
              State(page_module_name + self.production_volumes_table_id + '-upload-data', 'last_modified'),
              State(self.page_module_name + self.production_volumes_table_id + '-table', 'data'),
              ])
-        def update_inputs_table(parent_ids, upload_contents, old_table,
+        def update_inputs_table(parent_ids, upload_contents, old_table, page_current, page_size, sort_by, filter_query,
                                 upload_filename, upload_last_modified, table):
             trigger_dict = self.get_trigger(self.page_module_name)
             cm = KeyFacilitiesContentManager()
@@ -190,15 +275,16 @@ class Register(RegisterBase):
                     cm.make_current()
             elif '-upload-data' in trigger_dict['component']:
                 cm.parse_production_volumes_inputs_upload(upload_contents, upload_filename, upload_last_modified)
-            elif 'table' in trigger_dict['component']:
+            elif self.get_trigger_property() == 'data_previous':
+                # data/data_previous only hold the current page, so the edit is applied as a row patch
                 cm.save_production_volumes_inputs_table(old_table, table)
 
-            new_table = cm.get_production_volumes_inputs_table()
-            cm.save_msg()
-            return [new_table]
+            new_table, page_count = cm.get_production_volumes_inputs_page(page_current, page_size, sort_by, filter_query)
+            return [new_table, page_count, self.get_msg_data(cm.msg)]
 
         @app.callback(
             [Output(page_module_name + self.product_map_table_id + '-table', 'data'),
+             self.get_msg_output(self.product_map_table_id),
              ],
             [Input(page_module_name + self.data_selector_table_id + '-table', 'selected_row_ids'),
              Input(page_module_name + self.product_map_table_id + '-upload-data', 'contents'),
@@ -224,13 +310,13 @@ class Register(RegisterBase):
                 cm.save_product_map_inputs_table(old_table, table)
 
             new_table = cm.get_product_map_inputs_table()
-            cm.save_msg()
-            return [new_table]
+            return [new_table, self.get_msg_data(cm.msg)]
 
         @app.callback(
             [Output(page_module_name + self.market_breakdown_table_id + '-table', 'data'),
              Output(self.page_module_name + self.market_breakdown_table_id + '-table', 'selected_rows'),
              Output(self.page_module_name + self.market_breakdown_table_id + '-table', 'selected_row_ids'),
+             self.get_msg_output(self.market_breakdown_table_id),
              ],
             [Input(page_module_name + self.data_selector_table_id + '-table', 'selected_row_ids'),
              ])
@@ -244,8 +330,7 @@ class Register(RegisterBase):
                     cm.make_current()
 
             new_table, new_selected_ids, new_selected_rows = cm.get_market_breakdown_inputs_table()
-            cm.save_msg()
-            return [new_table, new_selected_rows, new_selected_ids]
+            return [new_table, new_selected_rows, new_selected_ids, self.get_msg_data(cm.msg)]
 
         # @app.callback(
         #     [Output(page_module_name + self.outputs_table_id + '-table', 'data'),
@@ -276,34 +361,89 @@ class Register(RegisterBase):
         #     cm.save_msg()
         #     return table, figure
 
+        @app.callback(
+            [Output(page_module_name + self.solver_id + '-job', 'data'),
+             Output(page_module_name + self.solver_id + '-interval', 'disabled'),
+             Output(page_module_name + self.solver_id + '-progress', 'children'),
+             ],
+            [Input(page_module_name + self.solver_id + '-run-button', 'n_clicks'),
+             Input(page_module_name + self.solver_id + '-cancel-button', 'n_clicks'),
+             Input(page_module_name + self.solver_id + '-interval', 'n_intervals'),
+             ],
+            [State(page_module_name + self.solver_id + '-job', 'data'),
+             State(self.page_module_name + self.market_breakdown_table_id + '-table', 'selected_row_ids'),
+             ])
+        def run_job(run, cancel, n_intervals, job, market_breakdown_ids):
+            trigger_dict = self.get_trigger(self.page_module_name)
+
+            if '-run-button' in trigger_dict['component']:
+                if job is not None and job['status'] not in JOB_FINISHED:
+                    return no_update, no_update, no_update
+                cm = KeyFacilitiesContentManager()
+                cm.make_current()
+                if market_breakdown_ids is not None:
+                    cm.save_market_breakdown_id(market_breakdown_ids[0])
+                status = job_runner.get_status(job_runner.submit(cm.get_current_id()))
+                return status, False, self.get_job_progress_text(status)
+            elif '-cancel-button' in trigger_dict['component']:
+                if job is not None:
+                    job_runner.cancel(job['job_id'])
+                return no_update, no_update, no_update
+            elif '-interval' in trigger_dict['component'] and job is not None:
+                status = job_runner.get_status(job['job_id'])
+                if status is None:
+                    return None, True, ''
+                finished = status['status'] in JOB_FINISHED
+                if finished:
+                    record_spans(status.get('spans'))
+                # only pass the job on when it finishes so the outputs refresh once
+                new_job = status if finished else no_update
+                return new_job, finished, self.get_job_progress_text(status)
+            return no_update, no_update, no_update
+
+        for table_id in [self.outputs_table_id, self.key_facilities_revenue_table_id]:
+            self.make_outputs_table_callback(table_id)
+
         @app.callback(
             [Output(page_module_name + self.doc_inputs_table_id + '-table', 'data'),
-             Output(page_module_name + self.outputs_table_id + '-table', 'data'),
-             Output(page_module_name + self.map_id + '-chart', 'figure'),
-             Output(page_module_name + self.key_facilities_revenue_table_id + '-table', 'data'),
-             Output(page_module_name + self.key_facilities_revenue_map_id + '-chart', 'figure'),
+             Output(page_module_name + self.map_id + '-figure', 'data'),
+             Output(page_module_name + self.key_facilities_revenue_map_id + '-figure', 'data'),
+             self.get_msg_output(self.doc_inputs_table_id),
              ],
             [Input(page_module_name + self.data_selector_table_id + '-table', 'selected_row_ids'),
-             Input(page_module_name + 'solver-run-button', 'n_clicks'),
+             Input(page_module_name + self.solver_id + '-job', 'data'),
              Input(page_module_name + self.doc_selector_table_id + '-table', 'selected_row_ids'),
              Input(page_module_name + self.doc_inputs_table_id + '-upload-data', 'contents'),
              Input(page_module_name + self.doc_inputs_table_id + '-table', 'data_previous'),
+             Input(page_module_name + self.map_id + '-chart', 'restyleData'),
+             Input(page_module_name + self.key_facilities_revenue_map_id + '-chart', 'restyleData'),
+             Input(page_module_name + self.map_id + '-chart', 'relayoutData'),
+             Input(page_module_name + self.key_facilities_revenue_map_id + '-chart', 'relayoutData'),
              ],
-            [State(self.page_module_name + self.market_breakdown_table_id + '-table', 'selected_row_ids'),
-             State(page_module_name + 'map' + '-chart', 'figure'),
+            [State(page_module_name + 'map' + '-chart', 'figure'),
              State(page_module_name + 'key-facilities-revenue-map' + '-chart', 'figure'),
              State(page_module_name + self.doc_inputs_table_id + '-upload-data', 'filename'),
              State(page_module_name + self.doc_inputs_table_id + '-upload-data', 'last_modified'),
              State(page_module_name + self.doc_inputs_table_id + '-table', 'data'),
              ])
-        def process_inputs(parent_ids, run, doc_ids, upload_contents, old_table, market_breakdown_ids, figure,
-                           revenue_figure, upload_filename, upload_last_modified, table):
+        def process_inputs(parent_ids, job, doc_ids, upload_contents, old_table, map_restyle, revenue_map_restyle,
+                           map_relayout, revenue_map_relayout, figure, revenue_figure, upload_filename,
+                           upload_last_modified, table):
             trigger_dict = self.get_trigger(self.page_module_name)
             cm = KeyFacilitiesContentManager()
             cm.make_current()
             dm = KeyFacilitiesDocManager()
             dm.make_current()
 
+            # outputs whose inputs did not change are returned as no_update
+            update_docs = update_map = update_revenue_map = True
+            include_grid = self.is_grid_layer_enabled(None, figure)
+            revenue_include_grid = self.is_grid_layer_enabled(None, revenue_figure)
+            cluster_column = self.get_cluster_column(map_relayout, figure)
+            revenue_cluster_column = self.get_cluster_column(revenue_map_relayout, revenue_figure)
+            bounds = self.get_map_bounds(map_relayout, figure)
+            revenue_bounds = self.get_map_bounds(revenue_map_relayout, revenue_figure)
+
             if self.data_selector_table_id in trigger_dict['component']:
                 if parent_ids is not None:
                     if len(parent_ids) > 0:
@@ -312,28 +452,171 @@ class Register(RegisterBase):
                         doc_id = cm.get_child_from_current('doc_id')
                         dm.update_current_id(doc_id)
                         dm.make_current()
-            elif '-run-button' in trigger_dict['component']:
-                if market_breakdown_ids is not None:
-                    cm.save_market_breakdown_id(market_breakdown_ids[0])
-                cm.process_key_facilities_inputs()
+            elif self.solver_id + '-job' in trigger_dict['component']:
+                # the background job has already written outputs when it succeeded
+                if job is None or job['status'] not in JOB_FINISHED:
+                    return no_update, no_update, no_update, no_update
+                update_docs = False
+            elif self.key_facilities_revenue_map_id + '-chart' in trigger_dict['component']:
+                update_docs = update_map = False
+                revenue_include_grid = self.is_grid_layer_enabled(revenue_map_restyle, revenue_figure)
+                if self.get_trigger_property() == 'relayoutData':
+                    update_revenue_map = self.is_map_stale(revenue_map_relayout, revenue_figure, revenue_cluster_column)
+            elif self.map_id + '-chart' in trigger_dict['component']:
+                update_docs = update_revenue_map = False
+                include_grid = self.is_grid_layer_enabled(map_restyle, figure)
+                if self.get_trigger_property() == 'relayoutData':
+                    update_map = self.is_map_stale(map_relayout, figure, cluster_column)
             elif self.doc_selector_table_id in trigger_dict['component']:
+                update_map = update_revenue_map = False
                 if doc_ids is not None:
                     cm.save_child('doc_id', doc_ids[0])
                     dm.update_current_id(doc_ids[0])
                     dm.make_current()
             elif '-upload-data' in trigger_dict['component']:
+                update_map = update_revenue_map = False
                 dm.parse_inputs_upload(upload_contents, upload_filename, upload_last_modified)
             elif 'table' in trigger_dict['component']:
+                update_map = update_revenue_map = False
                 dm.save_inputs_table(old_table, table)
-            new_table = dm.get_inputs_table()
-            dm.save_msg()
-
-            cf = content.ContentFactory(None, self.page_module_name)
-            cf.docs = dm.get_docs_dict()
-            cf.make_doc_items()
-            outputs_table = cm.get_outputs_table()
-            figure['data'] = cm.get_map_data()
-            revenue_table = cm.get_outputs_table()
-            revenue_figure['data'] = cm.get_map_data()
-            cm.save_msg()
-            return new_table, outputs_table, figure, revenue_table, revenue_figure
\ No newline at end of file
+
+            new_table = no_update
+            if update_docs:
+                new_table = dm.get_inputs_table()
+
+            if update_map:
+                figure['data'] = cm.get_map_data(include_grid=include_grid, cluster_column=cluster_column,
+                                                 bounds=bounds)
+            else:
+                figure = no_update
+            if update_revenue_map:
+                revenue_figure['data'] = cm.get_map_data(include_grid=revenue_include_grid,
+                                                         cluster_column=revenue_cluster_column, bounds=revenue_bounds)
+            else:
+                revenue_figure = no_update
+            return new_table, figure, revenue_figure, self.get_msg_data(dm.msg, cm.msg)
+
+        for map_id in [self.map_id, self.key_facilities_revenue_map_id]:
+            self.make_revenue_basis_callback(map_id)
+
+    def make_revenue_basis_callback(self, map_id):
+        self.app.clientside_callback(
+            REVENUE_BASIS_FUNCTION,
+            Output(self.page_module_name + map_id + '-chart', 'figure'),
+            [Input(self.page_module_name + map_id + '-figure', 'data'),
+             Input(self.page_module_name + map_id + '-revenue-basis', 'value')],
+            [State(self.page_module_name + map_id + '-chart', 'figure')],
+        )
+        return None
+
+    def make_outputs_table_callback(self, table_id):
+        @self.app.callback(
+            [Output(self.page_module_name + table_id + '-table', 'data'),
+             Output(self.page_module_name + table_id + '-table', 'page_count'),
+             self.get_msg_output(table_id),
+             ],
+            [Input(self.page_module_name + self.data_selector_table_id + '-table', 'selected_row_ids'),
+             Input(self.page_module_name + self.solver_id + '-job', 'data'),
+             Input(self.page_module_name + table_id + '-table', 'page_current'),
+             Input(self.page_module_name + table_id + '-table', 'page_size'),
+             Input(self.page_module_name + table_id + '-table', 'sort_by'),
+             Input(self.page_module_name + table_id + '-table', 'filter_query'),
+             ])
+        def update_outputs_table(parent_ids, job, page_current, page_size, sort_by, filter_query):
+            trigger_dict = self.get_trigger(self.page_module_name)
+            cm = KeyFacilitiesContentManager()
+            cm.make_current()
+
+            if self.data_selector_table_id in trigger_dict['component']:
+                if parent_ids is not None and len(parent_ids) > 0:
+                    cm.update_current_id(parent_ids[0])
+                    cm.make_current()
+            elif self.solver_id + '-job' in trigger_dict['component']:
+                if job is None or job['status'] not in JOB_FINISHED:
+                    return no_update, no_update, no_update
+                # the job message is shown once, by the outputs table refresh
+                if table_id == self.outputs_table_id:
+                    cm.msg = job['msg']
+
+            new_table, page_count = cm.get_outputs_page(page_current, page_size, sort_by, filter_query)
+            return new_table, page_count, self.get_msg_data(cm.msg)
+
+    def get_msg_output(self, source_id):
+        return Output(self.page_module_name + source_id + '-msg', 'data')
+
+    @staticmethod
+    def get_msg_data(*msgs):
+        # a new dict on every call, so the same message twice in a row still shows the popup again
+        msgs = [msg for msg in msgs if msg]
+        if len(msgs) == 0:
+            return None
+        return {'msg': ' '.join(msgs), 'time': time.time()}
+
+    @staticmethod
+    def get_trigger_property():
+        triggered = callback_context.triggered
+        if not triggered:
+            return None
+        return triggered[0]['prop_id'].rsplit('.', 1)[-1]
+
+    @staticmethod
+    def get_job_progress_text(job):
+        if job is None:
+            return ''
+        if job['status'] == 'running' and job['stage'] is not None:
+            return 'Processing: {} ({:.0f}%)'.format(job['stage'], 100 * (job['progress'] or 0))
+        elif job['status'] == 'queued':
+            return 'Queued'
+        return job['msg'] or ''
+
+    @staticmethod
+    def get_figure_cluster_column(figure):
+        for trace in figure['data']:
+            if 'meta' in trace:
+                return trace['meta'].get('cluster_column')
+        return None
+
+    @staticmethod
+    def get_cluster_column(relayout_data, figure):
+        # relayoutData only carries the zoom after a zoom, so pans keep the level of detail already on screen
+        if relayout_data is not None and 'mapbox.zoom' in relayout_data:
+            return KeyFacilitiesContentManager.get_map_cluster_column(relayout_data['mapbox.zoom'])
+        if any('meta' in trace for trace in figure['data']):
+            return Register.get_figure_cluster_column(figure)
+        return KeyFacilitiesContentManager.get_map_cluster_column(figure['layout']['mapbox']['zoom'])
+
+    @staticmethod
+    def get_figure_bounds(figure):
+        for trace in figure['data']:
+            if 'meta' in trace:
+                return trace['meta'].get('bounds')
+        return None
+
+    @staticmethod
+    def get_map_bounds(relayout_data, figure):
+        # the area around the view of the last pan or zoom, or the area already loaded when relayoutData has no view
+        view = KeyFacilitiesContentManager.get_map_view(relayout_data)
+        if view is None:
+            return Register.get_figure_bounds(figure)
+        return KeyFacilitiesContentManager.get_map_bounds(view)
+
+    @staticmethod
+    def is_map_stale(relayout_data, figure, cluster_column):
+        # pans and zooms keep the traces on screen while the band holds and the view stays inside the loaded area
+        if cluster_column != Register.get_figure_cluster_column(figure):
+            return True
+        view = KeyFacilitiesContentManager.get_map_view(relayout_data)
+        return not KeyFacilitiesContentManager.is_view_loaded(view, Register.get_figure_bounds(figure))
+
+    @staticmethod
+    def is_grid_layer_enabled(restyle_data, figure):
+        # restyleData is [changes, trace_indices]; the grid layer is lazily filled once it is made visible
+        if restyle_data is None or 'visible' not in restyle_data[0]:
+            return any(trace.get('visible') is True for trace in figure['data'] if trace.get('name') == 'grid')
+        grid_indices = [i for i, trace in enumerate(figure['data']) if trace.get('name') == 'grid']
+        changes, trace_indices = restyle_data
+        values = changes['visible'] if isinstance(changes['visible'], list) else [changes['visible']] * len(trace_indices)
+        for value, trace_index in zip(values, trace_indices):
+            if trace_index in grid_indices:
+                return value is True
+        return any(trace.get('visible') is True for trace in figure['data'] if trace.get('name') == 'grid')
\ No newline at end of file
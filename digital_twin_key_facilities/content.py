@@ -1,14 +1,34 @@
+import os
 import dash_html_components as html
+import dash_core_components as dcc
 
 from dashboardapp.plotlydashapp.pages.page import ContentBase
 from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
 from dashboardapp.docmanager.digital_twin_key_facilities_docs import KeyFacilitiesDocManager
 
 
+# the large tables and both maps are rendered empty and filled by their callbacks on page load, so the first
+# paint does not wait for the portfolio to be read
+LAZY_LAYOUT = os.environ.get('KEY_FACILITIES_LAZY_LAYOUT', '1') == '1'
+# sections whose callbacks return a status message; each gets a '<id>-msg' store read by the clientside popup
+MESSAGE_SOURCES = [
+    'key-facilities-selector',
+    'facilities-inputs',
+    'production-volumes-inputs',
+    'product-map-inputs',
+    'market-breakdown-inputs',
+    'outputs',
+    'key-facilities-revenue',
+    'doc-selector',
+    'doc-inputs',
+]
+
+
 class ContentFactory(ContentBase):
     def __init__(self, app, page_module_name, attributes=[]):
         super().__init__(app, page_module_name, attributes)
 
+        self.lazy = LAZY_LAYOUT
         self.title = None
         self.page_content = None
         self.cm = None
@@ -76,6 +96,7 @@ class ContentFactory(ContentBase):
             self.get_preview_notice_layout(),
             self.make_expandable_section_layout(
                 'key-facilities-revenue-section', self.app_mode, 'key_facilities_revenue_section', expanded=True),
+            html.Div([dcc.Store(id=self.page_module_name + source_id + '-msg') for source_id in MESSAGE_SOURCES]),
          ], id=self.page_module_name + 'inner-content', className='portal-page-inner-content ' + self.app_mode)
         return None
 
@@ -199,7 +220,7 @@ class ContentFactory(ContentBase):
     def make_facilities_inputs(self):
         table_id = 'facilities-inputs'
         id_slug = self.page_module_name + table_id
-        layout = self.cm.get_facilities_inputs_table_layout(id_slug)
+        layout = self.cm.get_facilities_inputs_table_layout(id_slug, lazy=self.lazy)
         self.facilities_inputs = {
             'title': 'Key facilities',
             'title_id': table_id,
@@ -211,7 +232,7 @@ class ContentFactory(ContentBase):
     def make_production_volumes_inputs(self):
         table_id = 'production-volumes-inputs'
         id_slug = self.page_module_name + table_id
-        layout = self.cm.get_production_volumes_inputs_table_layout(id_slug)
+        layout = self.cm.get_production_volumes_inputs_table_layout(id_slug, lazy=self.lazy)
         self.production_volumes_inputs = {
             'title': 'Facility production volumes',
             'title_id': table_id,
@@ -259,6 +280,20 @@ class ContentFactory(ContentBase):
                 id=id_slug + '-run-button',
                 className='btn btn-light section-button',
             ),
+            html.Button(
+                html.Div([
+                    html.I(
+                        html.Div(['Cancel'], className='button-text'),
+                        className='fas fa-times section-button-icon-text',
+                        style={'margin-left': 0}
+                    ),
+                ]),
+                id=id_slug + '-cancel-button',
+                className='btn btn-light section-button',
+            ),
+            html.Div(id=id_slug + '-progress', className='button-text'),
+            dcc.Interval(id=id_slug + '-interval', interval=1000, disabled=True),
+            dcc.Store(id=id_slug + '-job'),
         ])
         self.solver = {
             'title': 'Build key facilities model',
@@ -295,7 +330,7 @@ class ContentFactory(ContentBase):
     def make_outputs(self):
         table_id = 'outputs'
         id_slug = self.page_module_name + table_id
-        layout = self.cm.get_outputs_table_layout(id_slug)
+        layout = self.cm.get_outputs_table_layout(id_slug, lazy=self.lazy)
         self.outputs = {
             'title': 'Key facilities',
             'title_id': table_id,
@@ -307,7 +342,7 @@ class ContentFactory(ContentBase):
     def make_map(self):
         table_id = 'map'
         id_slug = self.page_module_name + table_id
-        layout = self.cm.get_map_layout(id_slug)
+        layout = self.cm.get_map_layout(id_slug, lazy=self.lazy)
         self.map = {
             'title': 'Map of key facilities',
             'title_id': table_id,
@@ -319,7 +354,7 @@ class ContentFactory(ContentBase):
     def make_key_facilities_revenue(self):
         table_id = 'key-facilities-revenue'
         id_slug = self.page_module_name + table_id
-        layout = self.cm.get_outputs_table_layout(id_slug)
+        layout = self.cm.get_outputs_table_layout(id_slug, lazy=self.lazy)
         self.key_facilities_revenue = {
             'title': 'Key facilities',
             'title_id': table_id,
@@ -331,7 +366,7 @@ class ContentFactory(ContentBase):
     def make_key_facilities_revenue_map(self):
         table_id = 'key-facilities-revenue-map'
         id_slug = self.page_module_name + table_id
-        layout = self.cm.get_map_layout(id_slug)
+        layout = self.cm.get_map_layout(id_slug, lazy=self.lazy)
         self.key_facilities_revenue_map = {
             'title': 'Map of key facilities',
             'title_id': table_id,
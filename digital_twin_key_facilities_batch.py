@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dashboardapp.calculationmanager.grid_lookup import GRID_RESOLUTIONS, get_grid_country_lookup
+
+
+# Headless processing of many key facilities records, e.g. to refresh every portfolio after a new market breakdown
+# is published:
+#   python -m dashboardapp.contentmanager.digital_twin_key_facilities_batch --all --market-breakdown-id <id>
+
+BATCH_WORKERS = int(os.environ.get('KEY_FACILITIES_BATCH_WORKERS', os.cpu_count() or 1))
+# spawned workers open their own store connections and warm their caches once each. fork starts them from the caches
+# warmed in the parent, but also from the parent's store connections, so it is only safe with a fork-safe store client.
+BATCH_START_METHOD = os.environ.get('KEY_FACILITIES_BATCH_START_METHOD', 'spawn')
+BATCH_SLOWEST = 5
+
+
+def get_active_record_ids():
+    from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
+
+    cm = KeyFacilitiesContentManager()
+    cm.enumerate_active()
+    return [row['id'] for row in cm.get_record_table(cm.active) if row.get('id') is not None]
+
+
+def get_market_breakdown_ids(record_ids):
+    from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
+
+    market_breakdown_ids = []
+    cm = KeyFacilitiesContentManager()
+    for record_id in record_ids:
+        try:
+            cm.update_current_id(record_id)
+            cm.make_current()
+            market_breakdown_id = cm.get_child_from_current('market_breakdown_id')
+        except Exception:
+            # the record fails again, and is reported, when its worker processes it
+            continue
+        if market_breakdown_id is not None and market_breakdown_id not in market_breakdown_ids:
+            market_breakdown_ids.append(market_breakdown_id)
+    return market_breakdown_ids
+
+
+def warm_caches(market_breakdown_ids):
+    # market indexes and grid lookups are only read while processing, so one copy serves every record
+    from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
+
+    cm = KeyFacilitiesContentManager()
+    for market_breakdown_id in market_breakdown_ids:
+        try:
+            cm.get_market_index(market_breakdown_id)
+        except Exception:
+            continue
+    for scale in GRID_RESOLUTIONS:
+        get_grid_country_lookup(scale)
+    return None
+
+
+def process_record(record_id, market_breakdown_id=None):
+    from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
+
+    start = time.perf_counter()
+    result = {'record_id': record_id, 'status': 'done', 'rows': None, 'msg': None, 'error': None, 'spans': []}
+    try:
+        cm = KeyFacilitiesContentManager()
+        cm.update_current_id(record_id)
+        cm.make_current()
+        if market_breakdown_id is not None:
+            cm.save_market_breakdown_id(market_breakdown_id)
+        df = cm.process_key_facilities_inputs()
+        result.update(rows=len(df) if df is not None else None, msg=cm.msg, spans=cm.stage_timer.spans)
+        if df is None:
+            # missing inputs or a grid error: nothing was processed and the message is the reason
+            result.update(status='failed', error=cm.msg or 'Key facility inputs were not processed.')
+    except Exception:
+        # process_key_facilities_inputs rolls its unit of work back, so a failed record keeps its previous outputs
+        result.update(status='failed', error=traceback.format_exc())
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def get_summary(results, seconds=None, slowest=BATCH_SLOWEST):
+    done = [result for result in results if result['status'] == 'done']
+    failed = [result for result in results if result['status'] == 'failed']
+    return {
+        'records': len(results),
+        'done': len(done),
+        'failed': len(failed),
+        'failed_ids': [result['record_id'] for result in failed],
+        'rows': sum(result['rows'] or 0 for result in done),
+        'seconds': seconds if seconds is not None else sum(result['seconds'] for result in results),
+        'slowest': [(result['record_id'], result['seconds'])
+                    for result in sorted(results, key=lambda result: result['seconds'], reverse=True)[:slowest]],
+    }
+
+
+def run_batch(record_ids=None, market_breakdown_id=None, max_workers=BATCH_WORKERS, start_method=BATCH_START_METHOD,
+              progress_callback=None):
+    # record_ids=None processes every active record; returns the per-record results and a summary
+    start = time.perf_counter()
+    if record_ids is None:
+        record_ids = get_active_record_ids()
+    if market_breakdown_id is not None:
+        market_breakdown_ids = [market_breakdown_id]
+    else:
+        market_breakdown_ids = get_market_breakdown_ids(record_ids)
+    if start_method == 'fork':
+        warm_caches(market_breakdown_ids)
+
+    results = []
+    if len(record_ids) > 0:
+        context = multiprocessing.get_context(start_method)
+        with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(record_ids))), mp_context=context,
+                                 initializer=warm_caches, initargs=(market_breakdown_ids,)) as executor:
+            futures = {executor.submit(process_record, record_id, market_breakdown_id): record_id
+                       for record_id in record_ids}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception:
+                    # the worker itself died (e.g. out of memory); the record is reported like any other failure
+                    result = {'record_id': futures[future], 'status': 'failed', 'rows': None, 'msg': None,
+                              'error': traceback.format_exc(), 'spans': [], 'seconds': 0.0}
+                results.append(result)
+                if progress_callback is not None:
+                    progress_callback(result, len(results), len(record_ids))
+
+    # results come back in completion order; the report follows the order the records were given in
+    order = {record_id: i for i, record_id in enumerate(record_ids)}
+    results.sort(key=lambda result: order[result['record_id']])
+    return {'results': results, 'summary': get_summary(results, time.perf_counter() - start)}
+
+
+def format_summary(report):
+    summary = report['summary']
+    lines = ['Processed {records} records in {seconds:.1f} s: {done} done, {failed} failed, '
+             '{rows} facility rows.'.format(**summary)]
+    if len(summary['slowest']) > 0:
+        lines.append('Slowest: ' + ', '.join('{} {:.1f} s'.format(record_id, seconds)
+                                             for record_id, seconds in summary['slowest']))
+    for result in report['results']:
+        if result['status'] == 'failed':
+            lines.append('FAILED {}: {}'.format(result['record_id'], result['error'].strip().splitlines()[-1]))
+        elif result['msg'] is not None:
+            lines.append('{}: {}'.format(result['record_id'], result['msg']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Process key facilities records in parallel.')
+    records = parser.add_mutually_exclusive_group(required=True)
+    records.add_argument('--records', help='comma separated key facilities record ids')
+    records.add_argument('--all', action='store_true', help='every active key facilities record')
+    parser.add_argument('--market-breakdown-id', help='market breakdown to switch every record to before processing')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--start-method', default=BATCH_START_METHOD)
+    parser.add_argument('--report', help='path of a JSON report with the result of every record')
+    args = parser.parse_args(argv)
+
+    record_ids = None if args.all else [record_id for record_id in args.records.split(',') if record_id]
+
+    def print_progress(result, n_finished, n_records):
+        print('[{}/{}] {} {} {:.1f} s'.format(n_finished, n_records, result['record_id'], result['status'],
+                                              result['seconds']))
+        return None
+
+    report = run_batch(record_ids, args.market_breakdown_id, args.workers, args.start_method, print_progress)
+    print(format_summary(report))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    return 1 if report['summary']['failed'] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import uuid
+import signal
+import _thread
+import tempfile
+import functools
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+JOB_DIR = os.environ.get('KEY_FACILITIES_JOB_DIR', os.path.join(tempfile.gettempdir(), 'key_facilities_jobs'))
+JOB_WORKERS = int(os.environ.get('KEY_FACILITIES_JOB_WORKERS', 2))
+JOB_START_METHOD = os.environ.get('KEY_FACILITIES_JOB_START_METHOD', 'spawn')
+JOB_STAGES = ['grid', 'country', 'reconciliation', 'revenue', 'save']
+JOB_FINISHED = ['done', 'failed', 'cancelled']
+# a running job touches its heartbeat file every JOB_HEARTBEAT_SECONDS and is reported failed once it has been
+# silent for JOB_STALE_SECONDS, e.g. because its worker was killed
+JOB_HEARTBEAT_SECONDS = 5
+JOB_STALE_SECONDS = int(os.environ.get('KEY_FACILITIES_JOB_STALE_SECONDS', 60))
+# files of jobs last touched longer ago are removed when a new job is submitted
+JOB_KEEP_SECONDS = int(os.environ.get('KEY_FACILITIES_JOB_KEEP_SECONDS', 24 * 60 * 60))
+JOB_SUFFIXES = ['.json', '.cancel', '.alive', '.json.tmp']
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobStore:
+    # File-backed job status shared by every worker process on the host; a stand-in for a real broker.
+    def __init__(self, directory=JOB_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, job_id, suffix='.json'):
+        return os.path.join(self.directory, job_id + suffix)
+
+    def get(self, job_id):
+        try:
+            with open(self.get_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, job):
+        job['updated'] = time.time()
+        path = self.get_path(job['job_id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(path + '.tmp', path)
+        return job
+
+    def update(self, job_id, **kwargs):
+        job = self.get(job_id) or {'job_id': job_id}
+        job.update(kwargs)
+        return self.save(job)
+
+    def request_cancel(self, job_id):
+        open(self.get_path(job_id, '.cancel'), 'w').close()
+        return None
+
+    def is_cancelled(self, job_id):
+        return os.path.exists(self.get_path(job_id, '.cancel'))
+
+    def touch(self, job_id):
+        open(self.get_path(job_id, '.alive'), 'w').close()
+        return None
+
+    def get_last_seen(self, job):
+        try:
+            alive = os.path.getmtime(self.get_path(job['job_id'], '.alive'))
+        except OSError:
+            alive = 0
+        return max(job.get('updated') or 0, alive)
+
+    def is_stale(self, job, now=None):
+        now = time.time() if now is None else now
+        return job['status'] == 'running' and now - self.get_last_seen(job) > JOB_STALE_SECONDS
+
+    def remove(self, job_id):
+        for suffix in JOB_SUFFIXES:
+            try:
+                os.remove(self.get_path(job_id, suffix))
+            except OSError:
+                pass
+        return None
+
+    def cleanup(self, max_age=JOB_KEEP_SECONDS):
+        now = time.time()
+        job_ids = set(name.split('.', 1)[0] for name in os.listdir(self.directory))
+        for job_id in job_ids:
+            job = self.get(job_id)
+            if job is None or job['status'] in JOB_FINISHED or self.is_stale(job, now):
+                if now - (self.get_last_seen(job) if job is not None else 0) > max_age:
+                    self.remove(job_id)
+        return None
+
+    def report_stage(self, job_id, stage):
+        if self.is_cancelled(job_id):
+            raise JobCancelled(job_id)
+        self.update(job_id, status='running', stage=stage,
+                    progress=JOB_STAGES.index(stage) / len(JOB_STAGES) if stage in JOB_STAGES else None)
+        return None
+
+
+class JobWatcher(threading.Thread):
+    # Runs next to a job in its worker: keeps the heartbeat fresh and, when a cancel is requested, interrupts the
+    # job's thread instead of waiting for the next stage. Once the job saves it can no longer be interrupted, so a
+    # save is never left half written.
+    current = None
+
+    def __init__(self, store, job_id, interval=JOB_HEARTBEAT_SECONDS):
+        super().__init__(daemon=True)
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.interruptible = True
+        self.cancelling = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if self.stopped.is_set():
+                    break
+                if self.interruptible and self.store.is_cancelled(self.job_id):
+                    self.cancelling = True
+                    _thread.interrupt_main()
+                    break
+            self.store.touch(self.job_id)
+        return None
+
+    def start(self):
+        # jobs run in the main thread of their worker, where interrupts are delivered
+        if JobWatcher.current is None and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, handle_interrupt)
+        JobWatcher.current = self
+        self.store.touch(self.job_id)
+        return super().start()
+
+    def set_interruptible(self, interruptible):
+        with self.lock:
+            self.interruptible = interruptible
+        return None
+
+    def stop(self):
+        self.set_interruptible(False)
+        self.stopped.set()
+        self.join()
+        return None
+
+
+def handle_interrupt(signum, frame):
+    watcher = JobWatcher.current
+    if watcher is not None and watcher.cancelling:
+        # an interrupt that arrives after the job left its interruptible part is dropped
+        if watcher.interruptible:
+            raise JobCancelled(watcher.job_id)
+        return None
+    raise KeyboardInterrupt
+
+
+def run_key_facilities_job(job_id, record_id, directory=JOB_DIR):
+    from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
+
+    store = JobStore(directory)
+    watcher = JobWatcher(store, job_id)
+
+    def report_stage(stage):
+        store.report_stage(job_id, stage)
+        if stage == 'save':
+            watcher.set_interruptible(False)
+        return None
+
+    try:
+        try:
+            report_stage('grid')
+            watcher.start()
+            cm = KeyFacilitiesContentManager()
+            cm.update_current_id(record_id)
+            cm.make_current()
+            cm.progress_callback = report_stage
+            cm.process_key_facilities_inputs()
+        finally:
+            if watcher.is_alive():
+                watcher.stop()
+        # spans go back with the job so the web process can add them to its metrics
+        store.update(job_id, status='done', stage=None, progress=1, msg=cm.msg, spans=cm.stage_timer.spans)
+    except JobCancelled:
+        store.update(job_id, status='cancelled', stage=None, msg='Processing of key facility inputs was cancelled.')
+    except Exception:
+        store.update(job_id, status='failed', stage=None, msg='Processing of key facility inputs failed.',
+                     error=traceback.format_exc())
+    return job_id
+
+
+class JobRunner:
+    def __init__(self, max_workers=JOB_WORKERS, directory=JOB_DIR, start_method=JOB_START_METHOD):
+        self.max_workers = max_workers
+        self.store = JobStore(directory)
+        self.start_method = start_method
+        self.executor = None
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                context = multiprocessing.get_context(self.start_method)
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            return self.executor
+
+    def reset_executor(self, executor):
+        # a worker that dies breaks its whole pool; the next job gets a new one
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        return None
+
+    def submit(self, record_id):
+        self.store.cleanup()
+        job_id = str(uuid.uuid4())
+        self.store.save({'job_id': job_id, 'record_id': record_id, 'status': 'queued', 'stage': None,
+                         'progress': 0, 'msg': None, 'submitted': time.time()})
+        executor = self.get_executor()
+        try:
+            future = executor.submit(run_key_facilities_job, job_id, record_id, self.store.directory)
+        except BrokenProcessPool:
+            self.reset_executor(executor)
+            executor = self.get_executor()
+            future = executor.submit(run_key_facilities_job, job_id, record_id, self.store.directory)
+        self.futures[job_id] = future
+        future.add_done_callback(functools.partial(self.on_job_done, job_id, executor))
+        return job_id
+
+    def on_job_done(self, job_id, executor, future):
+        # the job records its own outcome; this only catches jobs that never ran or whose worker died
+        self.futures.pop(job_id, None)
+        if future.cancelled():
+            error = None
+        else:
+            error = future.exception()
+            if error is None:
+                return None
+            if isinstance(error, BrokenProcessPool):
+                self.reset_executor(executor)
+        job = self.store.get(job_id)
+        if job is not None and job['status'] not in JOB_FINISHED:
+            self.store.update(job_id, status='failed', stage=None, msg='Processing of key facility inputs failed.',
+                              error=repr(error))
+        return None
+
+    def cancel(self, job_id):
+        job = self.store.get(job_id)
+        if job is not None and job['status'] not in JOB_FINISHED:
+            # a running job sees the request within a heartbeat, a queued one when it starts
+            self.store.request_cancel(job_id)
+            future = self.futures.get(job_id)
+            if job['status'] == 'queued' and (future is None or future.cancel()):
+                self.store.update(job_id, status='cancelled', msg='Processing of key facility inputs was cancelled.')
+        return None
+
+    def get_status(self, job_id):
+        job = self.store.get(job_id)
+        if job is not None and self.store.is_stale(job):
+            job = self.store.update(job_id, status='failed', stage=None,
+                                    msg='Processing of key facility inputs stopped responding.')
+        return job
+
+
+job_runner = JobRunner()
@@ -0,0 +1,182 @@
+import os
+import re
+import base64
+from functools import lru_cache
+from importlib import metadata
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+import colorlover as cl
+from matplotlib.colors import LinearSegmentedColormap
+
+from dashboardapp.calculationmanager.grid_engine import NO_CELL, get_grid_column
+from dashboardapp.calculationmanager.grid_overlay import get_grid_cells
+from dashboardapp.contentmanager.digital_twin_key_facilities import make_map_layout
+
+
+# Map building for the key facilities page, imported on first use so app workers do not load matplotlib, shapely,
+# colorlover and plotly graph_objs at boot.
+
+def get_package_version(package):
+    try:
+        return tuple(int(part) for part in re.findall(r'\d+', metadata.version(package))[:2])
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def is_typed_array_supported():
+    # plotly.js reads {dtype, bdata} arrays from 2.28, first bundled with dash 2.16, and plotly.py only accepts them
+    # in figures from 6.0; dash 1.x front ends draw nothing from them
+    dash_version, plotly_version = get_package_version('dash'), get_package_version('plotly')
+    return dash_version is not None and dash_version >= (2, 16) and plotly_version is not None and \
+        plotly_version >= (6, 0)
+
+
+# on wherever the installed dash and plotly read typed arrays, unless the environment says otherwise
+MAP_TYPED_ARRAYS = os.environ.get('KEY_FACILITIES_MAP_TYPED_ARRAYS', '1' if is_typed_array_supported() else '0') == '1'
+MAP_CLUSTER_MIN_POINTS = int(os.environ.get('KEY_FACILITIES_MAP_CLUSTER_MIN_POINTS', 2000))
+MAP_HOVER_TEMPLATE = '%{text}<br>Revenue: %{customdata:.2f} m CHF<extra></extra>'
+GRID_HOVER_TEMPLATE = 'Revenue: %{z:.2f} m CHF<extra></extra>'
+
+
+@lru_cache(maxsize=64)
+def get_facility_type_colors(facility_types):
+    cl_scale = cl.scales['9']['div']['Spectral']
+    color_scale = cl.to_numeric(list(cl_scale))
+    color_scale = [tuple(map(lambda x: x / 255, color)) for color in color_scale]
+    n_levels = len(facility_types)
+    color_map = LinearSegmentedColormap.from_list('my_list', color_scale, n_levels)
+    return {facility_types[i]: 'rgb' + str(tuple(map(lambda x: x * 255, color_map(i / n_levels)))[:-1])
+            for i in range(n_levels)}
+
+
+def encode_map_array(values, dtype='f8'):
+    values = np.asarray(values, dtype=dtype)
+    if MAP_TYPED_ARRAYS:
+        return {'dtype': dtype, 'bdata': base64.b64encode(values.tobytes()).decode()}
+    return values.tolist()
+
+
+def get_marker_sizes(revenue):
+    if np.nanmax(revenue, initial=0) not in [0, np.nan]:
+        return 10 + (revenue / np.nanmax(revenue)) * 40
+    return np.full(len(revenue), 10.0)
+
+
+def cluster_facilities(df, revenue_options, cluster_column):
+    # one marker per grid cell and facility type, sized by the summed revenue of the cell
+    df = df.loc[df[cluster_column] > NO_CELL]
+    groups = df.groupby([cluster_column, 'facility_type'], sort=False)
+    clusters = groups.agg(lat=('lat', 'mean'), lon=('lon', 'mean'), count=('lat', 'size'),
+                          facility_name=('facility_name', 'first'))
+    clusters = clusters.join(groups[revenue_options].sum()).reset_index()
+    multiple = clusters['count'] > 1
+    clusters.loc[multiple, 'facility_name'] = clusters.loc[multiple, 'count'].astype(str) + ' facilities'
+    return clusters
+
+
+def make_map_data(df, revenue_option, include_grid=False, cluster_column=None, revenue_options=None, bounds=None,
+                  facility_types=None):
+    # the revenues of every basis in revenue_options are shipped in the trace meta, so the basis selector restyles
+    # in the browser; marker sizes follow from them there (REVENUE_BASIS_FUNCTION)
+    # bounds: the area df was cut to, kept in meta so pans inside it keep the traces; facility_types: every type of
+    # the portfolio when df is only part of it
+    grid_df = df
+    revenue_options = [option for option in revenue_options or [] if option in df.columns and option != revenue_option]
+    revenue_options.append(revenue_option)
+    if cluster_column is not None and cluster_column in df.columns and len(df) > MAP_CLUSTER_MIN_POINTS:
+        df = cluster_facilities(df, revenue_options, cluster_column)
+
+    # one groupby pass instead of a boolean mask per facility type and column; types are taken from the
+    # unclustered rows so colours and trace order stay put across zoom bands
+    if facility_types is None:
+        facility_types = grid_df['facility_type'].dropna().unique()
+    facility_types = pd.Index(facility_types)
+    codes = facility_types.get_indexer(df['facility_type'])
+    color_scale = get_facility_type_colors(tuple(facility_types))
+
+    # hover text carries only the names; the revenue comes from customdata so a basis switch swaps two arrays
+    revenues = {option: df[option].to_numpy(dtype=float) for option in revenue_options}
+    sizes = get_marker_sizes(revenues[revenue_option])
+    text = df['facility_name'].astype(str).to_numpy(dtype=object)
+    lon = df['lon'].to_numpy(dtype=float)
+    lat = df['lat'].to_numpy(dtype=float)
+
+    data = []
+    for code, positions in sorted(pd.Series(codes).groupby(codes).indices.items()):
+        if code < 0:
+            continue
+        facility_type = facility_types[code]
+        data.append(dict(
+            type='scattermapbox',
+            lon=encode_map_array(lon[positions]),
+            lat=encode_map_array(lat[positions]),
+            mode='markers',
+            marker=dict(
+                color=color_scale[facility_type],
+                size=encode_map_array(sizes[positions], 'f4'),
+                opacity=0.8,
+            ),
+            # plotly.js typed arrays are numeric only, so the names stay a list
+            text=text[positions].tolist(),
+            customdata=encode_map_array(revenues[revenue_option][positions]),
+            hovertemplate=MAP_HOVER_TEMPLATE,
+            hoverlabel={'namelength': -1},
+            name=facility_type,
+            showlegend=True,
+            meta={
+                'cluster_column': cluster_column,
+                'bounds': bounds,
+                'revenue': {option: encode_map_array(revenues[option][positions]) for option in revenue_options},
+            },
+        ))
+
+    # the grid layer starts hidden, so cell geometries are only fetched once the layer is enabled
+    locations = []
+    cell_revenues = {option: np.array([]) for option in revenue_options}
+    grid_geojson = {'type': 'FeatureCollection', 'features': []}
+    if include_grid:
+        scale = '15arcmin' if get_grid_column('15arcmin') in grid_df.columns else '1deg'
+        grid_column = get_grid_column(scale)
+        rows = grid_df.loc[grid_df[grid_column] > NO_CELL]
+        cells = rows.groupby(rows[grid_column].astype(np.int64))[revenue_options].sum()
+        grid_geojson = get_grid_cells(cells.index, scale=scale)
+        locations = cells.index.astype(str).tolist()
+        cell_revenues = {option: cells[option].to_numpy(dtype=float) for option in revenue_options}
+    zmax = {option: float(np.nanmax(z, initial=0)) or 1 for option, z in cell_revenues.items()}
+
+    data += [dict(
+        type='choroplethmapbox',
+        geojson=grid_geojson,
+        locations=locations,
+        z=encode_map_array(cell_revenues[revenue_option]),
+        hovertemplate=GRID_HOVER_TEMPLATE,
+        name='grid',
+        colorscale='Viridis',
+        zmin=0,
+        zmax=zmax[revenue_option],
+        marker_line_width=0,
+        showlegend=True,
+        visible=True if include_grid else 'legendonly',
+        showscale=False,
+        marker_opacity=0.5,
+        meta={
+            'cluster_column': cluster_column,
+            'bounds': bounds,
+            'revenue': {option: {'z': encode_map_array(z), 'zmax': zmax[option]}
+                        for option, z in cell_revenues.items()},
+        },
+    )]
+    return data
+
+
+def make_map_figure(data, zoom_level, access_token):
+    layout = make_map_layout(zoom_level, access_token)
+
+    figure = go.Figure(
+        data=data,
+        layout=layout,
+    )
+
+    return figure
@@ -0,0 +1,143 @@
+import re
+import threading
+from difflib import SequenceMatcher
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+RECONCILER_CACHE_SIZE = 8
+
+
+class FacilityNameReconciler:
+    # Matches facility names to production volume rows in three passes:
+    # exact name, normalized name (both hash lookups) and a blocked fuzzy match for the rest.
+    # Fuzzy candidates share a token up to one deleted character (so 'plant 000003' still meets 'plant 0000037');
+    # tokens shared by more than max_block_size names, such as 'plant', are too common to narrow anything down.
+    def __init__(self, volumes, prefix_length=3, min_token_length=3, max_block_size=50, threshold=0.85):
+        self.prefix_length = prefix_length
+        self.min_token_length = min_token_length
+        self.max_block_size = max_block_size
+        self.threshold = threshold
+
+        volumes = volumes.loc[volumes['facility_id'].notna() & volumes['facility_name'].notna()]
+        names = volumes['facility_name'].astype(str).str[prefix_length:]
+
+        lookup = pd.DataFrame({
+            'exact': names.str.lower().values,
+            'normalized': [self.normalize(name) for name in names],
+            'facility_id': volumes['facility_id'].values,
+        })
+        self.exact_index = self.get_first_ids(lookup, 'exact')
+        self.normalized_index = self.get_first_ids(lookup, 'normalized')
+
+        candidates = lookup.drop_duplicates(subset=['normalized'], keep='first')
+        candidates = candidates.loc[candidates['normalized'] != '']
+        blocks = {}
+        for name, facility_id in zip(candidates['normalized'], candidates['facility_id']):
+            for key in self.get_block_keys(name):
+                blocks.setdefault(key, []).append((name, facility_id))
+        self.blocks = {key: block for key, block in blocks.items() if len(block) <= max_block_size}
+
+    @staticmethod
+    def normalize(name):
+        return ' '.join(re.sub(r'[^0-9a-z]+', ' ', str(name).lower()).split())
+
+    @staticmethod
+    def get_first_ids(lookup, column):
+        first = lookup.drop_duplicates(subset=[column], keep='first')
+        return dict(zip(first[column], first['facility_id']))
+
+    def get_block_keys(self, name):
+        # each token and its single-character deletions, so one typo in a token still shares a key
+        keys = set()
+        for token in name.split():
+            if len(token) < self.min_token_length:
+                continue
+            keys.add(token)
+            keys.update(token[:i] + token[i + 1:] for i in range(len(token)))
+        return keys
+
+    def get_fuzzy_match(self, name, claimed=()):
+        best_id, best_score = None, self.threshold
+        seen = set()
+        for key in self.get_block_keys(name):
+            for candidate, facility_id in self.blocks.get(key, []):
+                if candidate in seen or facility_id in claimed:
+                    continue
+                seen.add(candidate)
+                matcher = SequenceMatcher(None, name, candidate)
+                if matcher.real_quick_ratio() < best_score or matcher.quick_ratio() < best_score:
+                    continue
+                score = matcher.ratio()
+                if score >= best_score:
+                    best_id, best_score = facility_id, score
+        if best_id is None:
+            return None, np.nan
+        return best_id, best_score
+
+    def reconcile(self, names, fuzzy=None, claimed=None):
+        # fuzzy: boolean mask of rows that may fall back to fuzzy matching, defaults to all rows
+        # claimed: ids already held by other facilities; a fuzzy match never hands out a claimed id, and two fuzzy
+        # rows wanting the same id leave it to the better score, so no facility's revenue is counted twice
+        names = pd.Series(names).astype(str).reset_index(drop=True)
+        fuzzy = np.ones(len(names), dtype=bool) if fuzzy is None else np.asarray(fuzzy, dtype=bool)
+        claimed = set() if claimed is None else set(claimed)
+
+        ids = names.str.lower().map(self.exact_index).astype(object)
+        confidence = pd.Series(np.where(ids.notna(), 1.0, np.nan))
+
+        normalized = names.map(self.normalize)
+        missing = ids.isna()
+        ids[missing] = normalized[missing].map(self.normalized_index)
+        confidence[missing & ids.notna()] = 0.99
+
+        claimed.update(ids.dropna())
+        matches = []
+        for i in np.flatnonzero(ids.isna().values & fuzzy & (normalized != '').values):
+            facility_id, score = self.get_fuzzy_match(normalized[i], claimed)
+            if facility_id is not None:
+                matches.append((score, i, facility_id))
+        for score, i, facility_id in sorted(matches, key=lambda match: -match[0]):
+            if facility_id not in claimed:
+                claimed.add(facility_id)
+                ids[i], confidence[i] = facility_id, score
+
+        return pd.DataFrame({'id_from_volume': ids.astype(object).where(ids.notna(), None),
+                             'id_match_confidence': confidence})
+
+
+class ReconcilerCache:
+    # Reconcilers keyed by (record id, production volumes version). Building one indexes every volume row, which
+    # costs more than reconciling the few rows an edit touches; the version changes with every save of the volumes.
+    def __init__(self, maxsize=RECONCILER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.reconcilers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, volumes):
+        # key=None means the volumes carry no version, so the reconciler is built and not kept
+        if key is None:
+            return FacilityNameReconciler(volumes)
+        with self.lock:
+            if key in self.reconcilers:
+                self.reconcilers.move_to_end(key)
+                return self.reconcilers[key]
+
+        reconciler = FacilityNameReconciler(volumes)
+        with self.lock:
+            # older versions of the record's volumes are never asked for again
+            for old_key in [old_key for old_key in self.reconcilers if old_key[0] == key[0]]:
+                del self.reconcilers[old_key]
+            self.reconcilers[key] = reconciler
+            while len(self.reconcilers) > self.maxsize:
+                self.reconcilers.popitem(last=False)
+        return reconciler
+
+
+reconciler_cache = ReconcilerCache()
+
+
+def get_reconciler(key, volumes):
+    return reconciler_cache.get(key, volumes)
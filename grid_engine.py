@@ -0,0 +1,88 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# Cells per degree of every supported scale. Ids are row-major cell indexes counted from the north-west corner, so
+# a scale nests in every coarser scale whose cell count divides its own and parents follow from integer division.
+GRID_SCALES = OrderedDict([('1deg', 1), ('30arcmin', 2), ('15arcmin', 4), ('5arcmin', 12)])
+# these ids are not GridTools ids, so they get columns of their own; grid_1deg and grid_15arcmin keep holding GridTools
+# ids wherever older outputs carry them
+GRID_COLUMN_PREFIX = 'grid_cell_'
+NO_CELL = -1
+
+
+def get_grid_column(scale):
+    return GRID_COLUMN_PREFIX + scale
+
+
+GRID_COLUMNS = [get_grid_column(scale) for scale in GRID_SCALES]
+
+
+def get_grid_shape(scale):
+    cells = GRID_SCALES[scale]
+    return 180 * cells, 360 * cells
+
+
+def to_float_array(values):
+    # strings and other non-numeric entries from uploads become NaN and so invalid points
+    if isinstance(values, pd.Series):
+        return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+    return np.asarray(values, dtype=np.float64)
+
+
+def get_valid_points(lats, lons):
+    return np.isfinite(lats) & np.isfinite(lons) & (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+
+
+def get_grid_ids(lats, lons, scales=None):
+    # Ids of every requested scale from one pass at the finest common resolution; NO_CELL where a point is invalid.
+    # Coarser scales are integer divisions of the fine rows and columns, so a point's cells always nest.
+    scales = list(GRID_SCALES) if scales is None else list(scales)
+    lats = to_float_array(lats)
+    lons = to_float_array(lons)
+    valid = get_valid_points(lats, lons)
+
+    fine = int(np.lcm.reduce([GRID_SCALES[scale] for scale in scales]))
+    rows = np.floor((90 - np.where(valid, lats, 0)) * fine).astype(np.int64)
+    np.clip(rows, 0, 180 * fine - 1, out=rows)
+    cols = np.floor((np.where(valid, lons, 0) + 180) * fine).astype(np.int64) % (360 * fine)
+
+    grid_ids = OrderedDict()
+    for scale in scales:
+        ratio = fine // GRID_SCALES[scale]
+        ids = (rows // ratio) * get_grid_shape(scale)[1] + cols // ratio
+        ids[~valid] = NO_CELL
+        grid_ids[scale] = ids
+    return grid_ids
+
+
+def get_parent_ids(grid_ids, scale, parent_scale):
+    ratio, remainder = divmod(GRID_SCALES[scale], GRID_SCALES[parent_scale])
+    if remainder != 0:
+        raise ValueError('{} cells do not nest in {} cells'.format(scale, parent_scale))
+    grid_ids = np.asarray(grid_ids, dtype=np.int64)
+    rows, cols = np.divmod(grid_ids, get_grid_shape(scale)[1])
+    parent_ids = (rows // ratio) * get_grid_shape(parent_scale)[1] + cols // ratio
+    return np.where(grid_ids >= 0, parent_ids, NO_CELL)
+
+
+def get_cell_bounds(grid_ids, scale):
+    # (west, south, east, north) in degrees per cell
+    size = 1 / GRID_SCALES[scale]
+    rows, cols = np.divmod(np.asarray(grid_ids, dtype=np.int64), get_grid_shape(scale)[1])
+    west = cols * size - 180
+    north = 90 - rows * size
+    return west, north - size, west + size, north
+
+
+def get_cell_features(grid_ids, scale):
+    # GeoJSON polygons id'd by the grid id, for choropleth layers; no geometry library involved
+    grid_ids = np.asarray(grid_ids, dtype=np.int64)
+    grid_ids = grid_ids[grid_ids >= 0]
+    west, south, east, north = get_cell_bounds(grid_ids, scale)
+    return [{'type': 'Feature', 'id': str(grid_id), 'properties': {},
+             'geometry': {'type': 'Polygon', 'coordinates': [[[w, s], [e, s], [e, n], [w, n], [w, s]]]}}
+            for grid_id, w, s, e, n in zip(grid_ids.tolist(), west.tolist(), south.tolist(), east.tolist(),
+                                           north.tolist())]
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+from dashboardapp.calculationmanager.grid_engine import get_grid_ids, get_grid_shape
+
+
+GRID_LOOKUP_VERSION = 1
+GRID_LOOKUP_DIR = os.environ.get('GRID_LOOKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grid_lookup'))
+# scales with a lookup table; a scale's cell index is its grid engine id
+GRID_RESOLUTIONS = {'1deg': 1.0, '15arcmin': 0.25}
+NO_COUNTRY = -1
+
+
+def get_cell_index(lats, lons, scale):
+    # Row-major cell index counted from the north-west corner, -1 where lat/lon are missing or out of range.
+    return get_grid_ids(lats, lons, [scale])[scale]
+
+
+def get_table_paths(scale, directory=GRID_LOOKUP_DIR, version=GRID_LOOKUP_VERSION):
+    slug = 'grid_countries_{}_v{}'.format(scale, version)
+    return {
+        'codes': os.path.join(directory, slug + '_codes.npy'),
+        'border': os.path.join(directory, slug + '_border.npy'),
+        'countries': os.path.join(directory, slug + '_countries.json'),
+    }
+
+
+class GridCountryLookup:
+    # Memory-mapped cell -> country table; pages are shared between worker processes.
+    def __init__(self, scale, directory=GRID_LOOKUP_DIR, version=GRID_LOOKUP_VERSION):
+        self.scale = scale
+        self.version = version
+        paths = get_table_paths(scale, directory, version)
+        with open(paths['countries']) as f:
+            self.countries = np.array(json.load(f) + [None], dtype=object)
+        self.codes = np.load(paths['codes'], mmap_mode='r')
+        self.border = np.load(paths['border'], mmap_mode='r')
+
+    def get_countries(self, lats, lons):
+        return self.get_cell_countries(get_cell_index(lats, lons, self.scale))
+
+    def get_cell_countries(self, index):
+        # Returns countries and a mask of cells that need the geometry path (border, coastal or invalid).
+        index = np.asarray(index, dtype=np.int64)
+        valid = index >= 0
+        codes = np.full(len(index), NO_COUNTRY, dtype=np.int64)
+        codes[valid] = self.codes[index[valid]]
+        fallback = ~valid
+        fallback[valid] = self.border[index[valid]]
+        return self.countries[codes], fallback
+
+
+grid_country_lookups = {}
+grid_country_lookups_lock = threading.Lock()
+
+
+def get_grid_country_lookup(scale):
+    with grid_country_lookups_lock:
+        if scale not in grid_country_lookups:
+            paths = get_table_paths(scale)
+            if all(os.path.exists(path) for path in paths.values()):
+                grid_country_lookups[scale] = GridCountryLookup(scale)
+            else:
+                grid_country_lookups[scale] = None
+        return grid_country_lookups[scale]
+
+
+def build_grid_country_table(scale, directory=GRID_LOOKUP_DIR, chunk_size=100000):
+    # offline build step, so the geometry stack behind GridTools is not loaded with the lookup
+    from dashboardapp.calculationmanager.grid_tools import GridTools
+
+    resolution = GRID_RESOLUTIONS[scale]
+    n_rows, n_cols = get_grid_shape(scale)
+    n_cells = n_rows * n_cols
+    cell_countries = np.empty(n_cells, dtype=object)
+
+    for start in range(0, n_cells, chunk_size):
+        index = np.arange(start, min(start + chunk_size, n_cells))
+        lats = 90 - (index // n_cols + 0.5) * resolution
+        lons = (index % n_cols + 0.5) * resolution - 180
+        grid_tools = GridTools(lats=pd.Series(lats), lons=pd.Series(lons))
+        grid_ids = grid_tools.get_grid_ids(scale=scale)
+        countries, msg = grid_tools.get_grid_countries(grid_ids, scale=scale)
+        if msg is not None:
+            raise ValueError(msg)
+        cell_countries[index] = list(countries)
+
+    known = pd.Series(cell_countries).dropna()
+    country_list = sorted(known.unique().tolist())
+    codes = pd.Index(country_list).get_indexer(cell_countries).astype(np.int16)
+
+    # a cell is flagged when any edge neighbour (longitude wraps) has a different country, sea included
+    grid = codes.reshape(n_rows, n_cols)
+    border = np.zeros_like(grid, dtype=bool)
+    border[1:, :] |= grid[1:, :] != grid[:-1, :]
+    border[:-1, :] |= grid[:-1, :] != grid[1:, :]
+    border |= grid != np.roll(grid, 1, axis=1)
+    border |= grid != np.roll(grid, -1, axis=1)
+
+    os.makedirs(directory, exist_ok=True)
+    paths = get_table_paths(scale, directory)
+    np.save(paths['codes'], codes)
+    np.save(paths['border'], border.ravel())
+    with open(paths['countries'], 'w') as f:
+        json.dump(country_list, f)
+    return paths
+
+
+if __name__ == '__main__':
+    for scale in sys.argv[1:] or list(GRID_RESOLUTIONS):
+        print(build_grid_country_table(scale))
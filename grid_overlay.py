@@ -0,0 +1,55 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dashboardapp.calculationmanager.grid_engine import get_cell_features
+
+
+GRID_OVERLAY_CACHE_SIZE = 64
+
+
+def get_grid_ids_key(grid_ids, scale):
+    digest = hashlib.sha1(scale.encode())
+    for grid_id in sorted(str(grid_id) for grid_id in grid_ids):
+        digest.update(b'\n' + grid_id.encode())
+    return digest.hexdigest()
+
+
+class GridOverlayCache:
+    # Per-cell overlays keyed by a hash of the grid ids. Cell polygons come straight from the grid engine ids, so
+    # only the assembled feature collections are worth keeping.
+    def __init__(self, overlay_cache_size=GRID_OVERLAY_CACHE_SIZE):
+        self.overlay_cache_size = overlay_cache_size
+        self.overlays = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_cells(self, grid_ids, scale='15arcmin'):
+        # one feature per cell, id'd by the grid id, for choropleth layers coloured per cell
+        grid_ids = np.asarray([grid_id for grid_id in grid_ids if grid_id is not None and grid_id == grid_id],
+                              dtype=np.int64)
+        grid_ids = np.unique(grid_ids[grid_ids >= 0])
+        key = get_grid_ids_key(grid_ids.tolist(), scale)
+        with self.lock:
+            if key in self.overlays:
+                self.overlays.move_to_end(key)
+                return self.overlays[key]
+
+        cells = {'type': 'FeatureCollection', 'features': get_cell_features(grid_ids, scale)}
+        self.put_overlay(key, cells)
+        return cells
+
+    def put_overlay(self, key, overlay):
+        with self.lock:
+            self.overlays[key] = overlay
+            while len(self.overlays) > self.overlay_cache_size:
+                self.overlays.popitem(last=False)
+        return None
+
+
+grid_overlay_cache = GridOverlayCache()
+
+
+def get_grid_cells(grid_ids, scale='15arcmin'):
+    return grid_overlay_cache.get_cells(grid_ids, scale)
@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+from html import escape
+from collections import OrderedDict, deque, Counter
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+# Wiring: the app factory calls setup_instrumentation(app) once, right after creating the Dash app and before any
+# page registers its callbacks, so every page is timed and the endpoints are added once.
+METRICS_PATH = '/metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+CALLBACK_STATS_PATH = '/callback-stats'
+CALLBACK_STATS_SAMPLES = 1000
+CALLBACK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# the endpoints answer local requests only (a scraper or curl on the host) unless this is set, e.g. behind an
+# authenticating proxy
+INSTRUMENTATION_PUBLIC = os.environ.get('DASH_INSTRUMENTATION_PUBLIC', '').lower() in ('1', 'true', 'yes')
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+def get_peak_rss():
+    # peak resident set size of this process in bytes, None where the resource module is missing (Windows)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MetricsRegistry:
+    # In-process metrics rendered in the Prometheus text format. Each worker process keeps its own registry.
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def describe(self, name, metric_type, help_text):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = {'type': metric_type, 'help': help_text, 'values': OrderedDict()}
+        return None
+
+    def get_values(self, name, metric_type):
+        if name not in self.metrics:
+            self.metrics[name] = {'type': metric_type, 'help': name, 'values': OrderedDict()}
+        return self.metrics[name]['values']
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            values = self.get_values(name, 'summary')
+            key = tuple(sorted(labels.items()))
+            total, count = values.get(key, (0.0, 0))
+            values[key] = (total + value, count + 1)
+        return None
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            values = self.get_values(name, 'counter')
+            key = tuple(sorted(labels.items()))
+            values[key] = values.get(key, 0) + value
+        return None
+
+    def observe_histogram(self, name, value, buckets, **labels):
+        with self.lock:
+            values = self.get_values(name, 'histogram')
+            key = tuple(sorted(labels.items()))
+            counts, total, count = values.get(key, ([0] * len(buckets), 0.0, 0))
+            counts = [n + (value <= le) for n, le in zip(counts, buckets)]
+            values[key] = (counts, total + value, count + 1)
+            self.metrics[name]['buckets'] = buckets
+        return None
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.get_values(name, 'gauge')[tuple(sorted(labels.items()))] = value
+        return None
+
+    @staticmethod
+    def format_labels(key):
+        if len(key) == 0:
+            return ''
+        labels = ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for label, value in key)
+        return '{' + labels + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                lines.append('# HELP {} {}'.format(name, metric['help']))
+                lines.append('# TYPE {} {}'.format(name, metric['type']))
+                for key, value in metric['values'].items():
+                    labels = self.format_labels(key)
+                    if metric['type'] == 'histogram':
+                        for le, n in zip(metric['buckets'], value[0]):
+                            lines.append('{}_bucket{} {}'.format(name, self.format_labels(key + (('le', le),)), n))
+                        lines.append('{}_bucket{} {}'.format(name, self.format_labels(key + (('le', '+Inf'),)),
+                                                             value[2]))
+                        lines.append('{}_sum{} {}'.format(name, labels, value[1]))
+                        lines.append('{}_count{} {}'.format(name, labels, value[2]))
+                    elif metric['type'] == 'summary':
+                        lines.append('{}_sum{} {}'.format(name, labels, value[0]))
+                        lines.append('{}_count{} {}'.format(name, labels, value[1]))
+                    else:
+                        lines.append('{}{} {}'.format(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+metrics.describe('key_facilities_stage_seconds', 'summary', 'Wall time of key facilities processing stages.')
+metrics.describe('key_facilities_stage_rows_total', 'counter', 'Rows handled by key facilities processing stages.')
+metrics.describe('key_facilities_stage_peak_rss_delta_bytes', 'gauge',
+                 'Growth of the peak resident set size during the last run of each stage.')
+metrics.describe('dash_callback_seconds', 'histogram', 'Run time of dash callbacks, excluding serialization.')
+metrics.describe('dash_callback_request_bytes', 'summary', 'Size of dash callback requests.')
+metrics.describe('dash_callback_response_bytes', 'summary', 'Size of dash callback responses.')
+metrics.describe('dash_callback_triggers_total', 'counter', 'Dash callback calls by triggering property.')
+
+
+def record_spans(spans):
+    for span in spans or []:
+        metrics.observe('key_facilities_stage_seconds', span['seconds'], stage=span['stage'])
+        if span['rows'] is not None:
+            metrics.inc('key_facilities_stage_rows_total', span['rows'], stage=span['stage'])
+        if span['peak_rss_delta'] is not None:
+            metrics.set('key_facilities_stage_peak_rss_delta_bytes', span['peak_rss_delta'], stage=span['stage'])
+    return None
+
+
+class StageTimer:
+    # Sequential spans over the stages of a run: starting a stage closes the one before it.
+    def __init__(self, run='key_facilities'):
+        self.run = run
+        self.spans = []
+        self.current = None
+
+    def start(self, stage, rows=None):
+        self.stop()
+        self.current = {'stage': stage, 'rows': rows, 'start': time.perf_counter(), 'peak_rss': get_peak_rss()}
+        return None
+
+    def stop(self):
+        if self.current is None:
+            return None
+        current, self.current = self.current, None
+        peak_rss = get_peak_rss()
+        span = {
+            'stage': current['stage'],
+            'rows': current['rows'],
+            'seconds': time.perf_counter() - current['start'],
+            'peak_rss_delta': peak_rss - current['peak_rss'] if peak_rss is not None else None,
+        }
+        self.spans.append(span)
+        logger.info(json.dumps(dict(span, event='stage', run=self.run)))
+        return span
+
+    def get_summary(self, limit=3):
+        self.stop()
+        total = sum(span['seconds'] for span in self.spans)
+        if total <= 0:
+            return ''
+        slowest = sorted(self.spans, key=lambda span: span['seconds'], reverse=True)[:limit]
+        return 'Time: {:.1f} s, mostly {}.'.format(total, ', '.join(
+            '{} {:.1f} s ({:.0%})'.format(span['stage'], span['seconds'], span['seconds'] / total) for span in slowest))
+
+
+def is_local_request():
+    # a request relayed by a proxy on the same host also comes from loopback, so forwarded requests are not local
+    from flask import request
+
+    return request.remote_addr in LOCAL_ADDRESSES and 'X-Forwarded-For' not in request.headers and \
+        'Forwarded' not in request.headers
+
+
+def restricted(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        from flask import abort
+
+        if not INSTRUMENTATION_PUBLIC and not is_local_request():
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def setup_instrumentation(app):
+    # the one entry point for the app factory, see the note at the top
+    instrument_app(app)
+    register_metrics_endpoint(app.server)
+    return app
+
+
+def register_metrics_endpoint(server, path=METRICS_PATH):
+    # server is the Flask app behind dash (app.server); registering twice is a no-op
+    from flask import Response
+
+    if 'instrumentation_metrics' in server.view_functions:
+        return None
+
+    @restricted
+    def instrumentation_metrics():
+        return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+    server.add_url_rule(path, 'instrumentation_metrics', instrumentation_metrics)
+    return None
+
+
+class CallbackStats:
+    # Recent calls per callback for the stats page; the full history only goes to the metrics registry.
+    def __init__(self, samples=CALLBACK_STATS_SAMPLES):
+        self.samples = samples
+        self.calls = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, callback, seconds, request_bytes, response_bytes, trigger):
+        with self.lock:
+            if callback not in self.calls:
+                self.calls[callback] = deque(maxlen=self.samples)
+            self.calls[callback].append((seconds, request_bytes, response_bytes, trigger))
+        metrics.observe_histogram('dash_callback_seconds', seconds, CALLBACK_BUCKETS, callback=callback)
+        metrics.observe('dash_callback_request_bytes', request_bytes, callback=callback)
+        metrics.observe('dash_callback_response_bytes', response_bytes, callback=callback)
+        metrics.inc('dash_callback_triggers_total', callback=callback, trigger=trigger)
+        return None
+
+    def get_rows(self):
+        with self.lock:
+            calls = {callback: list(samples) for callback, samples in self.calls.items()}
+        rows = []
+        for callback, samples in calls.items():
+            seconds = np.array([sample[0] for sample in samples])
+            triggers = Counter(sample[3] for sample in samples)
+            rows.append({
+                'callback': callback,
+                'calls': len(samples),
+                'p50': np.percentile(seconds, 50),
+                'p95': np.percentile(seconds, 95),
+                'p99': np.percentile(seconds, 99),
+                'max': seconds.max(),
+                'request_bytes': np.mean([sample[1] for sample in samples]),
+                'response_bytes': np.mean([sample[2] for sample in samples]),
+                'trigger': triggers.most_common(1)[0][0],
+            })
+        return sorted(rows, key=lambda row: row['p99'], reverse=True)
+
+    def render_html(self):
+        header = ['Callback', 'Calls', 'p50 s', 'p95 s', 'p99 s', 'Max s', 'Mean request KB', 'Mean response KB',
+                  'Most frequent trigger']
+        lines = ['<html><head><title>Callback stats</title></head><body>',
+                 '<p>Last {} calls per callback, slowest p99 first.</p>'.format(self.samples),
+                 '<table border="1" cellpadding="4"><tr>' + ''.join('<th>{}</th>'.format(col) for col in header)
+                 + '</tr>']
+        for row in self.get_rows():
+            cells = [escape(row['callback']), row['calls'], '{:.3f}'.format(row['p50']), '{:.3f}'.format(row['p95']),
+                     '{:.3f}'.format(row['p99']), '{:.3f}'.format(row['max']),
+                     '{:.1f}'.format(row['request_bytes'] / 1024), '{:.1f}'.format(row['response_bytes'] / 1024),
+                     escape(str(row['trigger']))]
+            lines.append('<tr>' + ''.join('<td>{}</td>'.format(cell) for cell in cells) + '</tr>')
+        lines.append('</table></body></html>')
+        return '\n'.join(lines)
+
+
+callback_stats = CallbackStats()
+
+
+def get_callback_name(func, output):
+    # callback functions share names (update_inputs_table), so the first output tells them apart
+    outputs = output if isinstance(output, (list, tuple)) else [output]
+    if len(outputs) == 0:
+        return func.__name__
+    first = outputs[0]
+    name = '{}:{}.{}'.format(func.__name__, getattr(first, 'component_id', first),
+                             getattr(first, 'component_property', ''))
+    if len(outputs) > 1:
+        name += ' +{}'.format(len(outputs) - 1)
+    return name
+
+
+def record_callback_response(response):
+    from flask import g, request
+
+    call = g.pop('instrumented_callback', None)
+    if call is not None:
+        callback, seconds, trigger = call
+        callback_stats.record(callback, seconds, request.content_length or 0,
+                              response.calculate_content_length() or 0, trigger)
+    return response
+
+
+def instrument_app(app):
+    # Wraps app.callback so every callback registered afterwards, including the RegisterBase helpers, is timed.
+    # Payload sizes are read from the HTTP request and response, so nothing is serialized twice.
+    if getattr(app, 'callbacks_instrumented', False):
+        return app
+    register_callback = app.callback
+
+    def callback(*args, **kwargs):
+        decorator = register_callback(*args, **kwargs)
+
+        def instrument(func):
+            name = get_callback_name(func, args[0] if len(args) > 0 else kwargs.get('output', []))
+
+            @functools.wraps(func)
+            def wrapper(*func_args, **func_kwargs):
+                from flask import g
+                from dash import callback_context
+
+                triggered = callback_context.triggered
+                trigger = triggered[0]['prop_id'] if triggered else None
+                start = time.perf_counter()
+                try:
+                    return func(*func_args, **func_kwargs)
+                finally:
+                    g.instrumented_callback = (name, time.perf_counter() - start, trigger)
+            return decorator(wrapper)
+        return instrument
+
+    app.callback = callback
+    app.callbacks_instrumented = True
+    app.server.after_request(record_callback_response)
+    register_callback_stats_endpoint(app.server)
+    return app
+
+
+def register_callback_stats_endpoint(server, path=CALLBACK_STATS_PATH):
+    from flask import Response
+
+    if 'instrumentation_callback_stats' in server.view_functions:
+        return None
+
+    @restricted
+    def instrumentation_callback_stats():
+        return Response(callback_stats.render_html(), content_type='text/html; charset=utf-8')
+
+    server.add_url_rule(path, 'instrumentation_callback_stats', instrumentation_callback_stats)
+    return None
@@ -0,0 +1,106 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+MARKET_INDEX_CACHE_SIZE = 16
+
+
+def get_markets_digest(markets_table):
+    # content version of an outputs table, for breakdown records that carry no stored revision
+    markets = pd.DataFrame(markets_table)
+    digest = hashlib.sha1(','.join(map(str, markets.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(markets.astype(str), index=False).values.tobytes())
+    return 'sha1:' + digest.hexdigest()
+
+
+class MarketIndex:
+    # Hash lookups over a market breakdown outputs table, built once per breakdown id and version.
+    # Duplicate keys resolve to the first row, as the boolean-mask .values[0] lookups did.
+    def __init__(self, markets_table, market_breakdown_id=None, version=None):
+        self.market_breakdown_id = market_breakdown_id
+        self.version = version
+        self.markets = pd.DataFrame(markets_table)
+
+        keys = ['product_group', 'product', 'region', 'sub_region']
+        unique_markets = self.markets.drop_duplicates(subset=keys, keep='first')
+        self.results = unique_markets.set_index(keys)['result']
+
+        totals = self.markets.loc[self.markets['sub_region'] == 'Total']
+        totals = totals.drop_duplicates(subset=['product', 'region'], keep='first')
+        self.totals = totals.set_index(['product', 'region'])['result']
+
+        countries = self.markets.loc[self.markets['country'].notna()]
+        countries = countries.drop_duplicates(subset=['country'], keep='first')
+        self.country_regions = dict(zip(countries['country'], countries['region']))
+
+    def get_result(self, product_group, product, region, sub_region):
+        return self.results.get((product_group, product, region, sub_region))
+
+    def get_total_result(self, product, region):
+        return self.totals.get((product, region))
+
+    def get_total_revenue(self):
+        return self.get_result('Total', 'Total', 'Total', 'Total')
+
+    def get_regions(self, countries):
+        return [self.country_regions.get(country) for country in countries]
+
+
+class MarketIndexCache:
+    # Indexes keyed by (breakdown id, version). The version is read from the breakdown record, so a save seen by any
+    # process (web workers, job and batch pools) moves every process on to the new outputs; there is no local
+    # invalidation to miss.
+    def __init__(self, maxsize=MARKET_INDEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, market_breakdown_id, loader, version=None):
+        # version=None means no version is known for the record; the outputs are then loaded and hashed on every call,
+        # which still skips rebuilding the index
+        markets_table = None
+        if version is None:
+            markets_table = loader(market_breakdown_id)
+            version = get_markets_digest(markets_table)
+        key = (market_breakdown_id, version)
+        with self.lock:
+            if key in self.indexes:
+                self.indexes.move_to_end(key)
+                return self.indexes[key]
+
+        if markets_table is None:
+            markets_table = loader(market_breakdown_id)
+        index = MarketIndex(markets_table, market_breakdown_id, version)
+
+        with self.lock:
+            # older versions of the breakdown are never asked for again
+            for old_key in [old_key for old_key in self.indexes if old_key[0] == market_breakdown_id]:
+                del self.indexes[old_key]
+            self.indexes[key] = index
+            while len(self.indexes) > self.maxsize:
+                self.indexes.popitem(last=False)
+        return index
+
+    def invalidate(self, market_breakdown_id=None):
+        # only frees memory; stale entries are never served because the version comes from the record
+        with self.lock:
+            if market_breakdown_id is None:
+                self.indexes.clear()
+            else:
+                for key in [key for key in self.indexes if key[0] == market_breakdown_id]:
+                    del self.indexes[key]
+        return None
+
+
+market_index_cache = MarketIndexCache()
+
+
+def get_market_index(market_breakdown_id, loader, version=None):
+    return market_index_cache.get(market_breakdown_id, loader, version)
+
+
+def invalidate_market_index(market_breakdown_id=None):
+    return market_index_cache.invalidate(market_breakdown_id)
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class RevenueEngine:
+    # Allocates market results to facilities with sparse matrix products:
+    # (facility x product) @ (product x end_product) @ (end_product x region).
+    # Missing or NaN entries contribute zero, matching the pandas sums this replaces.
+    def __init__(self, market_index, volumes, product_map):
+        self.market_index = market_index
+        self.volumes = volumes.loc[volumes['facility_id'].notna()]
+        self.product_map = product_map
+
+        self.products = pd.Index(pd.concat([self.volumes['product'], product_map['product']]).dropna().unique())
+        self.end_products = pd.Index(product_map['end_product'].dropna().unique())
+
+        totals = market_index.totals.reset_index()
+        self.regions = pd.Index(totals['region'].dropna().unique())
+
+        self.product_end_product_matrix = self.get_product_end_product_matrix()
+        self.end_product_region_matrix = self.get_end_product_region_matrix(totals)
+
+    def get_product_end_product_matrix(self):
+        rows = self.products.get_indexer(self.product_map['product'])
+        cols = self.end_products.get_indexer(self.product_map['end_product'])
+        values = self.product_map['share'].astype(float).fillna(0).values / 100
+        mask = (rows >= 0) & (cols >= 0)
+        return sparse.csr_matrix((values[mask], (rows[mask], cols[mask])),
+                                 shape=(len(self.products), len(self.end_products)))
+
+    def get_end_product_region_matrix(self, totals):
+        rows = self.end_products.get_indexer(totals['product'])
+        cols = self.regions.get_indexer(totals['region'])
+        values = totals['result'].astype(float).fillna(0).values
+        mask = (rows >= 0) & (cols >= 0)
+        return sparse.csr_matrix((values[mask], (rows[mask], cols[mask])),
+                                 shape=(len(self.end_products), len(self.regions)))
+
+    def get_facility_product_matrix(self, facility_ids, share_column):
+        facilities = pd.DataFrame({'facility_id': np.asarray(facility_ids), 'row': np.arange(len(facility_ids))})
+        pairs = facilities.merge(self.volumes[['facility_id', 'product', share_column]], on='facility_id', how='inner')
+        rows = pairs['row'].values
+        cols = self.products.get_indexer(pairs['product'])
+        values = pairs[share_column].astype(float).fillna(0).values
+        mask = cols >= 0
+        return sparse.csr_matrix((values[mask], (rows[mask], cols[mask])),
+                                 shape=(len(facility_ids), len(self.products)))
+
+    def get_facility_end_product_matrix(self, facility_ids, share_column):
+        facility_products = self.get_facility_product_matrix(facility_ids, share_column)
+        return facility_products @ self.product_end_product_matrix
+
+    def get_region_revenues(self, facility_ids, facility_regions):
+        facility_end_products = self.get_facility_end_product_matrix(facility_ids, 'region_share')
+        facility_region_revenues = (facility_end_products @ self.end_product_region_matrix).tocsr()
+
+        region_index = self.regions.get_indexer(pd.Index(facility_regions))
+        revenues = np.zeros(len(facility_ids))
+        valid = np.flatnonzero(region_index >= 0)
+        if len(valid) > 0:
+            revenues[valid] = np.asarray(facility_region_revenues[valid, region_index[valid]]).ravel()
+        return revenues
+
+    def get_global_revenues(self, facility_ids):
+        facility_end_products = self.get_facility_end_product_matrix(facility_ids, 'global_share')
+        if 'Total' not in self.regions:
+            return np.zeros(len(facility_ids))
+        total_revenues = self.end_product_region_matrix[:, self.regions.get_loc('Total')]
+        return np.asarray((facility_end_products @ total_revenues).todense()).ravel()
+
+    def get_total_revenue(self):
+        return self.market_index.get_total_revenue()
+
+    def get_input_revenues(self, revenue_shares):
+        return self.get_total_revenue() * revenue_shares
+
+
+class ScenarioRevenueEngine(RevenueEngine):
+    # RevenueEngine over several market breakdowns. Products, end products and facility shares do not depend on the
+    # scenario, so the end_product x region matrices are stacked side by side, one block of regions per scenario,
+    # and each revenue basis for every scenario is a single sparse product returning a facility x scenario array.
+    def __init__(self, market_indexes, volumes, product_map):
+        self.market_indexes = market_indexes
+        self.volumes = volumes.loc[volumes['facility_id'].notna()]
+        self.product_map = product_map
+
+        self.products = pd.Index(pd.concat([self.volumes['product'], product_map['product']]).dropna().unique())
+        self.end_products = pd.Index(product_map['end_product'].dropna().unique())
+
+        totals = [market_index.totals.reset_index() for market_index in market_indexes]
+        self.regions = pd.Index(pd.concat([scenario_totals['region'] for scenario_totals in totals]).dropna().unique())
+
+        self.product_end_product_matrix = self.get_product_end_product_matrix()
+        self.end_product_region_matrix = sparse.hstack(
+            [self.get_end_product_region_matrix(scenario_totals) for scenario_totals in totals], format='csr')
+
+    def get_region_revenues(self, facility_ids, facility_regions, scenarios=None, share_column='region_share'):
+        # scenarios: positions of the market breakdowns whose country -> region mapping gave facility_regions
+        if scenarios is None:
+            scenarios = range(len(self.market_indexes))
+        scenarios = np.asarray(scenarios, dtype=np.int64)
+        facility_end_products = self.get_facility_end_product_matrix(facility_ids, share_column)
+        facility_region_revenues = (facility_end_products @ self.end_product_region_matrix).tocsr()
+
+        region_index = self.regions.get_indexer(pd.Index(facility_regions))
+        revenues = np.zeros((len(facility_ids), len(scenarios)))
+        valid = np.flatnonzero(region_index >= 0)
+        if len(valid) > 0 and len(scenarios) > 0:
+            cols = scenarios[None, :] * len(self.regions) + region_index[valid, None]
+            values = facility_region_revenues[np.repeat(valid, len(scenarios)), cols.ravel()]
+            revenues[valid] = np.asarray(values).reshape(len(valid), len(scenarios))
+        return revenues
+
+    def get_global_revenues(self, facility_ids):
+        facility_end_products = self.get_facility_end_product_matrix(facility_ids, 'global_share')
+        if 'Total' not in self.regions:
+            return np.zeros((len(facility_ids), len(self.market_indexes)))
+        cols = np.arange(len(self.market_indexes)) * len(self.regions) + self.regions.get_loc('Total')
+        return np.asarray((facility_end_products @ self.end_product_region_matrix[:, cols]).todense())
+
+    def get_total_revenue(self):
+        return np.array([market_index.get_total_revenue() for market_index in self.market_indexes], dtype=float)
+
+    def get_input_revenues(self, revenue_shares):
+        return np.outer(np.asarray(revenue_shares, dtype=float), self.get_total_revenue())
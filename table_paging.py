@@ -0,0 +1,163 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+TABLE_PAGE_SIZE = 20
+TABLE_CACHE_SIZE = 16
+
+FILTER_OPERATORS = [
+    ['ge ', '>='],
+    ['le ', '<='],
+    ['lt ', '<'],
+    ['gt ', '>'],
+    ['ne ', '!='],
+    ['eq ', '='],
+    ['contains '],
+    ['datestartswith '],
+]
+
+
+def split_filter_part(filter_part):
+    # parses one '&&' clause of a DataTable filter_query, e.g. {lat} > 10 or {facility_type} contains PL
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[0] if len(value_part) > 0 else ''
+                if v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+
+def apply_filter(df, filter_query):
+    if not filter_query:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, value = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+        col = df[col_name]
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            if isinstance(value, float):
+                col = pd.to_numeric(col, errors='coerce')
+            else:
+                col = col.astype(str)
+            mask &= getattr(col, operator)(value).values
+        elif operator in ('contains', 'datestartswith'):
+            text = '%g' % value if isinstance(value, float) else str(value)
+            if operator == 'contains':
+                mask &= col.astype(str).str.contains(text, case=False, regex=False).values
+            else:
+                mask &= col.astype(str).str.startswith(text).values
+    return df.loc[mask]
+
+
+def apply_sort(df, sort_by):
+    sort_by = [col for col in sort_by or [] if col['column_id'] in df.columns]
+    if len(sort_by) == 0:
+        return df
+    return df.sort_values([col['column_id'] for col in sort_by],
+                          ascending=[col['direction'] == 'asc' for col in sort_by],
+                          kind='mergesort', na_position='last')
+
+
+def get_page(df, page_current=0, page_size=TABLE_PAGE_SIZE, sort_by=None, filter_query=None):
+    # returns (page rows, page count) for a DataTable in page_action='custom' mode
+    view = apply_sort(apply_filter(df, filter_query), sort_by)
+    page_size = page_size or TABLE_PAGE_SIZE
+    page_count = max(1, math.ceil(len(view) / page_size))
+    page_current = min(page_current or 0, page_count - 1)
+    page = view.iloc[page_current * page_size: (page_current + 1) * page_size]
+    return page.to_dict(orient='records'), page_count
+
+
+def apply_patch(df, old_rows, new_rows):
+    # applies the edits between two versions of a page to the full table, matching rows on 'id'
+    old_ids = [row.get('id') for row in old_rows or []]
+    new_rows = [row for row in new_rows or [] if row.get('id') is not None]
+    new_ids = [row['id'] for row in new_rows]
+    deleted = [row_id for row_id in old_ids if row_id is not None and row_id not in new_ids]
+    if len(deleted) > 0:
+        df = df.loc[~df['id'].isin(deleted)]
+    if len(new_rows) > 0:
+        patch = pd.DataFrame(new_rows).set_index('id')
+        df = df.set_index('id')
+        common = patch.index.intersection(df.index)
+        added = patch.index.difference(df.index)
+        for col in patch.columns:
+            if col not in df.columns:
+                df[col] = None
+            elif df[col].dtype != patch[col].dtype:
+                numeric = pd.api.types.is_numeric_dtype(df[col]) and pd.api.types.is_numeric_dtype(patch[col])
+                df[col] = df[col].astype(float if numeric else object)
+            df.loc[common, col] = patch.loc[common, col]
+        if len(added) > 0:
+            df = pd.concat([df, patch.loc[added]])
+        df = df.reset_index()
+    return df
+
+
+class TableCache:
+    # full tables per (record id, child) and version token, so paging, sorting and filtering skip the store read
+    def __init__(self, maxsize=TABLE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.tables.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.tables.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, df):
+        with self.lock:
+            self.tables[key] = (version, df)
+            self.tables.move_to_end(key)
+            while len(self.tables) > self.maxsize:
+                self.tables.popitem(last=False)
+        return df
+
+
+table_cache = TableCache()
+
+
+def iter_components(component):
+    yield component
+    children = getattr(component, 'children', None)
+    if not isinstance(children, (list, tuple)):
+        children = [children]
+    for child in children:
+        if hasattr(child, 'to_plotly_json'):
+            yield from iter_components(child)
+
+
+def set_custom_paging(layout, table_id, page_count, page_size=TABLE_PAGE_SIZE):
+    # switches the DataTable built by get_table_layout to server-side paging, sorting and filtering
+    for component in iter_components(layout):
+        if getattr(component, 'id', None) == table_id:
+            component.page_action = 'custom'
+            component.sort_action = 'custom'
+            component.sort_mode = 'multi'
+            component.filter_action = 'custom'
+            component.page_current = 0
+            component.page_size = page_size
+            component.page_count = page_count
+    return layout
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_key_facilities import make_content_manager
+from benchmarks.synthetic import make_key_facilities_inputs
+
+
+REVENUE_COLUMNS = ['region_assumption_revenue', 'global_assumption_revenue', 'input_assumption_revenue']
+
+
+def get_facility(cm, position=0):
+    cm.make_current()
+    return cm.get_facilities_inputs_page()[0][position]
+
+
+def get_facility_with_id(cm):
+    cm.make_current()
+    rows = cm.get_facilities_inputs_page()[0]
+    return next(position for position, row in enumerate(rows) if pd.notna(row['facility_id']))
+
+
+def edit_facility(cm, position=0, **values):
+    cm.make_current()
+    rows = cm.get_facilities_inputs_page()[0]
+    edited = [dict(row) for row in rows]
+    edited[position].update(values)
+    cm.save_facilities_inputs_table(rows, edited)
+    cm.make_current()
+    return None
+
+
+def get_stage_rows(cm):
+    return {span['stage']: span['rows'] for span in cm.stage_timer.spans}
+
+
+def get_full_run(cm):
+    cm.make_current()
+    cm.invalidate_outputs()
+    cm.make_current()
+    return cm.process_key_facilities_inputs()
+
+
+def assert_same_outputs(df, expected):
+    df = df.set_index('facility_uid').sort_index()
+    expected = expected.set_index('facility_uid').sort_index()
+    pd.testing.assert_series_equal(df['facility_id'], expected['facility_id'], check_dtype=False)
+    for col in REVENUE_COLUMNS:
+        np.testing.assert_allclose(df[col].astype(float), expected[col].astype(float), rtol=1e-9)
+
+
+def test_moving_a_facility_within_its_cell_recomputes_nothing():
+    cm = make_content_manager(make_key_facilities_inputs(2000))
+    cm.process_key_facilities_inputs()
+    # a facility uploaded with its id, as one without is matched again on every edit
+    position = get_facility_with_id(cm)
+    facility = get_facility(cm, position)
+    # the centre of its 1deg cell, so the facility keeps its country
+    edit_facility(cm, position, lat=np.floor(facility['lat']) + 0.5)
+
+    df = cm.process_key_facilities_inputs()
+    stage_rows = get_stage_rows(cm)
+    assert stage_rows['reconciliation'] == 0
+    assert stage_rows['revenue'] == 0
+    assert df.loc[df['facility_uid'] == facility['facility_uid'], 'lat'].iloc[0] == np.floor(facility['lat']) + 0.5
+    assert_same_outputs(df, get_full_run(cm))
+
+
+def test_renaming_a_facility_without_an_id_reconciles_only_that_facility():
+    cm = make_content_manager(make_key_facilities_inputs(2000))
+    cm.process_key_facilities_inputs()
+    facility = get_facility(cm)
+    edit_facility(cm, facility_id=None, facility_name=facility['facility_name'] + ' ')
+
+    df = cm.process_key_facilities_inputs()
+    stage_rows = get_stage_rows(cm)
+    assert stage_rows['reconciliation'] == 1
+    assert stage_rows['revenue'] < len(df)
+    assert_same_outputs(df, get_full_run(cm))
+
+
+def test_a_repeat_run_does_not_reload_an_unchanged_market_breakdown(monkeypatch):
+    cm = make_content_manager(make_key_facilities_inputs(2000))
+    loads = []
+    load_market_breakdown_outputs = cm.load_market_breakdown_outputs
+
+    def counting_load(market_breakdown_id):
+        loads.append(market_breakdown_id)
+        return load_market_breakdown_outputs(market_breakdown_id)
+
+    monkeypatch.setattr(cm, 'load_market_breakdown_outputs', counting_load)
+    monkeypatch.setattr(cm, 'get_market_breakdown_version', lambda uid: 'modified:1')
+
+    cm.process_key_facilities_inputs()
+    assert len(loads) == 1
+    edit_facility(cm, lat=np.floor(get_facility(cm)['lat']) + 0.5)
+    cm.process_key_facilities_inputs()
+    assert len(loads) == 1
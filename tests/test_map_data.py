@@ -0,0 +1,46 @@
+import numpy as np
+
+from dashboardapp.contentmanager.digital_twin_key_facilities import KeyFacilitiesContentManager
+
+from benchmarks.bench_key_facilities import make_content_manager
+from benchmarks.synthetic import make_key_facilities_inputs
+
+
+def make_relayout_data(west, south, east, north):
+    # what plotly reports after a pan or zoom, corners clockwise from the top left
+    return {'mapbox.zoom': 9, 'mapbox._derived': {'coordinates': [[west, north], [east, north], [east, south],
+                                                                  [west, south]]}}
+
+
+def get_points(data):
+    traces = [trace for trace in data if trace['type'] == 'scattermapbox']
+    return np.concatenate([trace['lat'] for trace in traces]), np.concatenate([trace['lon'] for trace in traces])
+
+
+def test_facilities_past_the_last_cluster_band_are_cut_to_the_view():
+    cm = make_content_manager(make_key_facilities_inputs(5000))
+    df = cm.process_key_facilities_inputs()
+    lat, lon = df['lat'].iloc[0], df['lon'].iloc[0]
+    view = KeyFacilitiesContentManager.get_map_view(make_relayout_data(lon - 2, lat - 1, lon + 2, lat + 1))
+    bounds = KeyFacilitiesContentManager.get_map_bounds(view)
+    assert bounds == [lon - 4, lat - 2, lon + 4, lat + 2]
+
+    cluster_column = KeyFacilitiesContentManager.get_map_cluster_column(9)
+    assert cluster_column is None
+    data = cm.get_map_data(cluster_column=cluster_column, bounds=bounds)
+    points_lat, points_lon = get_points(data)
+    inside = (df['lat'] >= lat - 2) & (df['lat'] <= lat + 2) & (df['lon'] >= lon - 4) & (df['lon'] <= lon + 4)
+    assert 0 < len(points_lat) == inside.sum() < len(df)
+    assert ((points_lat >= lat - 2) & (points_lat <= lat + 2)).all()
+    assert ((points_lon >= lon - 4) & (points_lon <= lon + 4)).all()
+    assert all(trace['meta']['bounds'] == bounds for trace in data)
+
+
+def test_a_pan_past_the_loaded_area_needs_new_traces():
+    bounds = KeyFacilitiesContentManager.get_map_bounds([10, 40, 14, 42])
+    assert KeyFacilitiesContentManager.is_view_loaded([11, 40.5, 15, 42.5], bounds)
+    assert not KeyFacilitiesContentManager.is_view_loaded([15, 40, 19, 42], bounds)
+    # a view across the antimeridian
+    bounds = KeyFacilitiesContentManager.get_map_bounds([178, -18, 182, -16])
+    assert KeyFacilitiesContentManager.is_view_loaded([-179, -18, -177, -16], bounds)
+    assert KeyFacilitiesContentManager.get_map_bounds([-200, -80, 200, 80]) == [-180, -90, 180, 90]
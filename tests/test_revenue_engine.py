@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from dashboardapp.calculationmanager.market_index import MarketIndex
+from dashboardapp.calculationmanager.revenue_engine import RevenueEngine
+
+from benchmarks.synthetic import make_key_facilities_inputs
+
+
+def get_reference_revenue(row, markets, volumes, product_map, share_column, region):
+    # the per-row df.apply allocation the engine replaced
+    facility_id = row['facility_id']
+    if facility_id not in volumes['facility_id'].tolist():
+        return 0
+    products = volumes.loc[volumes['facility_id'] == facility_id, ['product', share_column]]
+    revenue = 0
+    for i in products.index:
+        product = products.loc[i, 'product']
+        share = products.loc[i, share_column]
+        end_products = product_map.loc[product_map['product'] == product].copy()
+        end_products['market_revenue'] = [markets.loc[(markets['product'] == end_product) &
+                                                      (markets['region'] == (region or row['grid_region'])) &
+                                                      (markets['sub_region'] == 'Total'), 'result'].values[0]
+                                          for end_product in end_products['end_product']]
+        end_products['revenue'] = end_products['market_revenue'] * (end_products['share'] / 100) * share
+        revenue += end_products['revenue'].sum()
+    return revenue
+
+
+def make_allocation_inputs(n=200, seed=0):
+    inputs = make_key_facilities_inputs(n, seed)
+    markets = pd.DataFrame(inputs['market_breakdown'])
+    df = inputs['facilities_inputs'].dropna(subset=['facility_id']).reset_index(drop=True)
+    regions = dict(zip(markets['country'], markets['region']))
+    df['grid_region'] = df['country'].map(regions)
+
+    volumes = inputs['production_volumes_inputs']
+    volumes = volumes.loc[volumes['facility_id'].isin(df['facility_id'])].copy()
+    volumes['grid_region'] = volumes['facility_id'].map(df.set_index('facility_id')['grid_region'])
+    volumes['region_share'] = volumes['volume'] / volumes.groupby(['grid_region', 'product'])['volume'].transform('sum')
+    volumes['global_share'] = volumes['volume'] / volumes.groupby(['product'])['volume'].transform('sum')
+    return df, markets, volumes, inputs['product_map_inputs']
+
+
+def test_region_and_global_revenues_match_row_by_row_allocation():
+    df, markets, volumes, product_map = make_allocation_inputs()
+    engine = RevenueEngine(MarketIndex(markets), volumes, product_map)
+
+    region_revenues = engine.get_region_revenues(df['facility_id'], df['grid_region'])
+    global_revenues = engine.get_global_revenues(df['facility_id'])
+
+    expected_region = df.apply(
+        lambda row: get_reference_revenue(row, markets, volumes, product_map, 'region_share', None), axis=1)
+    expected_global = df.apply(
+        lambda row: get_reference_revenue(row, markets, volumes, product_map, 'global_share', 'Total'), axis=1)
+    np.testing.assert_allclose(region_revenues, expected_region.values, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(global_revenues, expected_global.values, rtol=1e-9, atol=1e-9)
+
+
+def test_unknown_facilities_get_zero_revenue():
+    df, markets, volumes, product_map = make_allocation_inputs(20)
+    engine = RevenueEngine(MarketIndex(markets), volumes, product_map)
+
+    revenues = engine.get_region_revenues(pd.Series(['missing', None]), pd.Series(['Europe', None]))
+    np.testing.assert_array_equal(revenues, [0, 0])
@@ -0,0 +1,206 @@
+import os
+import base64
+import tempfile
+import functools
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+
+UPLOAD_CHUNK_ROWS = 50000
+UPLOAD_DECODE_CHARS = 4 * 1024 * 1024
+UPLOAD_SPOOL_BYTES = 16 * 1024 * 1024
+# identifier and text columns of the key facilities tables; read as strings whatever their first values look like
+UPLOAD_STRING_COLUMNS = ['facility_uid', 'facility_id', 'facility_name', 'facility_type', 'note', 'country', 'product',
+                         'end_product', 'end_product_group']
+
+
+def decode_upload_contents(contents, chunk_chars=UPLOAD_DECODE_CHARS):
+    # Decodes a dcc.Upload data URL slice by slice into a spooled temporary file, never holding the decoded bytes
+    # next to the encoded string. chunk_chars is kept a multiple of 4 so every slice decodes on its own.
+    chunk_chars -= chunk_chars % 4
+    start = contents.index(',') + 1
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    for i in range(start, len(contents), chunk_chars):
+        spool.write(base64.b64decode(contents[i:i + chunk_chars]))
+    spool.seek(0)
+    return spool
+
+
+def open_csv_strings(spool):
+    # every column read as text, converted per batch by cast_batch
+    read_options = pa_csv.ReadOptions(block_size=UPLOAD_DECODE_CHARS)
+    spool.seek(0)
+    column_names = pa_csv.open_csv(spool, read_options=read_options).schema.names
+    spool.seek(0)
+    convert_options = pa_csv.ConvertOptions(column_types={col: pa.string() for col in column_names},
+                                            strings_can_be_null=True)
+    return pa_csv.open_csv(spool, read_options=read_options, convert_options=convert_options)
+
+
+def get_csv_schema(spool, string_columns=UPLOAD_STRING_COLUMNS):
+    # The streaming reader fixes column types from the first block, so a column of numbers or dates that turns to
+    # text further down would fail the upload. The first block only proposes the types; the whole file is then read
+    # as text once and a column that does not convert in some batch is kept as text.
+    read_options = pa_csv.ReadOptions(block_size=UPLOAD_DECODE_CHARS)
+    spool.seek(0)
+    schema = get_widened_schema(pa_csv.open_csv(spool, read_options=read_options).schema, string_columns)
+    for batch in open_csv_strings(spool):
+        for i, field in enumerate(schema):
+            if not pa.types.is_string(field.type):
+                try:
+                    batch.column(field.name).cast(field.type)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                    schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+
+def read_csv_batches(spool, schema, chunk_rows=UPLOAD_CHUNK_ROWS):
+    for batch in open_csv_strings(spool):
+        for offset in range(0, batch.num_rows, chunk_rows):
+            yield cast_batch(batch.slice(offset, chunk_rows), schema)
+
+
+def get_widened_schema(schema, string_columns=UPLOAD_STRING_COLUMNS, keep_null=False):
+    # integers are widened to float and empty columns to string, as later rows may hold decimals or text
+    fields = []
+    for field in schema:
+        if field.name in string_columns or (pa.types.is_null(field.type) and not keep_null):
+            field = field.with_type(pa.string())
+        elif pa.types.is_integer(field.type):
+            field = field.with_type(pa.float64())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def get_merged_type(type_a, type_b):
+    if type_a == type_b or pa.types.is_null(type_b):
+        return type_a
+    if pa.types.is_null(type_a):
+        return type_b
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in [type_a, type_b]):
+        return pa.float64()
+    return pa.string()
+
+
+def get_merged_schema(schema_a, schema_b):
+    return pa.schema([field.with_type(get_merged_type(field.type, schema_b.field(field.name).type))
+                      for field in schema_a])
+
+
+def cast_batch(batch, schema):
+    return pa.RecordBatch.from_arrays([batch.column(field.name).cast(field.type) for field in schema], schema=schema)
+
+
+def get_xlsx_schema(spool, chunk_rows=UPLOAD_CHUNK_ROWS, string_columns=UPLOAD_STRING_COLUMNS):
+    # every chunk is typed on its own, so the schema that holds them all is only known once the sheet has been read;
+    # the chunks are dropped as they go and the sheet is read again to write them
+    schema = None
+    for batch in iter_xlsx_batches(spool, chunk_rows, string_columns):
+        schema = batch.schema if schema is None else get_merged_schema(schema, batch.schema)
+    return get_widened_schema(schema, [])
+
+
+def read_xlsx_batches(spool, schema, chunk_rows=UPLOAD_CHUNK_ROWS, string_columns=UPLOAD_STRING_COLUMNS):
+    for batch in iter_xlsx_batches(spool, chunk_rows, string_columns):
+        yield cast_batch(batch, schema)
+
+
+def iter_xlsx_batches(spool, chunk_rows=UPLOAD_CHUNK_ROWS, string_columns=UPLOAD_STRING_COLUMNS):
+    from openpyxl import load_workbook
+
+    spool.seek(0)
+    workbook = load_workbook(spool, read_only=True, data_only=True)
+    rows = workbook.worksheets[0].iter_rows(values_only=True)
+    header = [str(col) for col in next(rows, [])]
+    n_batches = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield get_xlsx_batch(chunk, header, string_columns)
+            n_batches += 1
+            chunk = []
+    if len(chunk) > 0 or n_batches == 0:
+        yield get_xlsx_batch(chunk, header, string_columns)
+    workbook.close()
+
+
+def get_xlsx_batch(chunk, header, string_columns=UPLOAD_STRING_COLUMNS):
+    df = pd.DataFrame.from_records(chunk, columns=header)
+    for col in df.columns:
+        if col in string_columns or (df[col].dtype == object and df[col].dropna().map(type).nunique() > 1):
+            # cells of one column may hold numbers and text alike; numbers are kept as they read, e.g. '42'
+            df[col] = df[col].map(lambda value: None if value is None or value != value else str(value))
+    schema = get_widened_schema(pa.Schema.from_pandas(df, preserve_index=False), string_columns, keep_null=True)
+    return pa.RecordBatch.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def read_upload_batches(spool, read_batches, schema):
+    try:
+        for batch in read_batches(spool, schema):
+            yield batch
+    finally:
+        spool.close()
+
+
+def parse_upload_stream(contents, filename, chunk_rows=UPLOAD_CHUNK_ROWS):
+    # Returns (error_msg, reader) like ContentManager.parse_upload, with reader a pyarrow RecordBatchReader that
+    # yields the file chunk by chunk, so the caller can write it out without holding the whole table. The file is
+    # checked in full before returning; reading the batches applies the same conversions and does not fail on them.
+    if filename.lower().endswith('.csv'):
+        get_schema = get_csv_schema
+        read_batches = functools.partial(read_csv_batches, chunk_rows=chunk_rows)
+    elif filename.lower().endswith(('.xlsx', '.xlsm')):
+        # both passes chunk the sheet alike, so every chunk is typed as it was when the schema was merged
+        get_schema = functools.partial(get_xlsx_schema, chunk_rows=chunk_rows)
+        read_batches = functools.partial(read_xlsx_batches, chunk_rows=chunk_rows)
+    else:
+        return 'There was an error processing this file: Unsupported file type: {}'.format(filename), None
+    spool = None
+    try:
+        spool = decode_upload_contents(contents)
+        schema = get_schema(spool)
+    except (ValueError, TypeError, KeyError, pa.ArrowException, OSError) as e:
+        if spool is not None:
+            spool.close()
+        return 'There was an error processing this file: {}'.format(e), None
+    batches = read_upload_batches(spool, read_batches, schema)
+    return None, pa.RecordBatchReader.from_batches(schema, batches)
+
+
+def append_upload_columns(reader, uid_column=None):
+    # row ids, and a new uuid per row in uid_column, added batch by batch
+    schema = reader.schema
+    add_id = 'id' not in schema.names
+    if add_id:
+        schema = schema.append(pa.field('id', pa.int64()))
+    if uid_column is not None:
+        schema = schema.append(pa.field(uid_column, pa.string()))
+
+    def get_batches():
+        offset = 0
+        for batch in reader:
+            columns = list(batch.columns)
+            if add_id:
+                columns.append(pa.array(np.arange(offset, offset + batch.num_rows, dtype=np.int64)))
+            if uid_column is not None:
+                columns.append(pa.array(make_uuid4_strings(batch.num_rows), type=pa.string()))
+            offset += batch.num_rows
+            yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+    return pa.RecordBatchReader.from_batches(schema, get_batches())
+
+
+def make_uuid4_strings(n):
+    # Random version 4 UUIDs for n rows built with array operations rather than n uuid.uuid4() calls.
+    raw = np.frombuffer(os.urandom(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    digits = np.frombuffer(raw.tobytes().hex().encode(), dtype='S1').reshape(n, 32)
+    dash = np.full((n, 1), b'-', dtype='S1')
+    chars = np.hstack([digits[:, :8], dash, digits[:, 8:12], dash, digits[:, 12:16], dash,
+                       digits[:, 16:20], dash, digits[:, 20:]])
+    return np.ascontiguousarray(chars).view('S36').ravel().astype(str)